@@ -0,0 +1,195 @@
+"""Several processes playing the same games through one data.db (SHARED_DB=1).
+
+    python bench/cas_stress.py [--procs 4] [--games 8] [--players 4] [--ops 2000] [--seed 1]
+                               [--shards 0] [--unsafe]
+
+The parent creates and starts --games group games. Each worker process then
+imports main against the same file and loops --ops times: pick a random game,
+read whose turn it is and play that turn's next move (80%), or have a random
+player leave (10%) or come back (10%). A move is what the board offers in the
+phase read: pick a question or reroll while choosing, done on a question,
+confirm while waiting. One move in four is a random one of these regardless
+of phase, like a click on an old board. Workers race on purpose, since they
+all hit the same few games. After they finish, the database is checked:
+
+  no errors          no operation raised
+  no double advance  every turn index was advanced from at most once
+  no lost turn       games.current_turn_index == the workers' successful confirms
+  actions            one qtype='stress' action row per successful pick
+  moves              per game, 'done_wait' + 'confirmed' rows == successful dones
+                     and 'confirmed' rows == successful confirms: no move was
+                     applied twice or out of phase
+  rerolls            rerolls spent == successful rerolls
+  ring               active players form one next/prev cycle through turn_uid
+
+--shards N spreads the games over N shard files (DB_SHARDS), so commits to
+games on different shards stop queueing on one file's write lock; compare
+the turns/s line against --shards 0.
+
+--unsafe runs the same workload with SHARED_DB off. Each process then trusts
+its own write-behind cache, and the checks fail. Operations that raise on
+the resulting inconsistent state are counted as errors.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import collections
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+MOVES = {"choose": "pick", "question": "done", "wait_confirm": "confirm"}
+
+
+def play(main, rng, wid, g, moves):
+    """One move of g's current turn, as the player to move would click it."""
+    gid, actor = g["id"], g["turn_uid"]
+    if actor is None:
+        return
+    move = MOVES.get(g["phase"], "pick")
+    if move == "pick" and rng.random() < 0.15:
+        move = "reroll"
+    if rng.random() < 0.25:
+        move = rng.choice(("pick", "reroll", "done", "confirm"))
+    if move == "pick":
+        ok = main.ask_question(gid, actor, "stress", "normal", f"w{wid}")
+    elif move == "reroll":
+        ok = main.use_reroll(gid, actor)
+    elif move == "done":
+        ok = main.await_confirm(gid, actor)
+    else:
+        ok, _ = main.turn_transition(gid, actor, last_status="confirmed", phase="wait_confirm")
+        if ok:
+            moves["advanced"].append((gid, ok["current_turn_index"]-1))
+            return
+    if ok:
+        moves[move].append(gid)
+
+
+def worker(job):
+    wid, ops, gids, seed = job
+    import main
+    rng = random.Random(seed*1000+wid)
+    moves, errors = collections.defaultdict(list), 0
+    t = time.perf_counter()
+    for _ in range(ops):
+        gid = rng.choice(gids)
+        r = rng.random()
+        try:
+            g = main.get_game(gid)
+            if r < 0.8:
+                play(main, rng, wid, g, moves)
+            else:
+                ps = main.list_players(gid)
+                if r < 0.9 and len(ps) > 2:
+                    main.remove_player(gid, int(rng.choice(ps)["user_id"]))
+                elif r >= 0.9:
+                    uid = gid*100+rng.randint(1, 4)
+                    main.upsert_player(gid, uid, f"p{uid}")
+        except Exception:
+            errors += 1
+    main.CACHE.flush()
+    return dict(moves), dict(main.CAS_STATS, errors=errors), time.perf_counter()-t
+
+
+def check_ring(conn, gid):
+    g = conn.execute("SELECT turn_uid FROM games WHERE id=?;", (gid,)).fetchone()
+    ps = {r["user_id"]: r for r in conn.execute("SELECT * FROM game_players WHERE game_id=? AND active=1;", (gid,))}
+    if not ps:
+        return g["turn_uid"] is None
+    seen, uid = [], g["turn_uid"]
+    while uid in ps and uid not in seen:
+        seen.append(uid)
+        nxt = ps[uid]["next_uid"]
+        if nxt not in ps or ps[nxt]["prev_uid"] != uid:
+            return False
+        uid = nxt
+    return uid == g["turn_uid"] and len(seen) == len(ps)
+
+
+def cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--procs", type=int, default=4)
+    ap.add_argument("--games", type=int, default=8)
+    ap.add_argument("--players", type=int, default=4)
+    ap.add_argument("--ops", type=int, default=2000, help="operations per process")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--shards", type=int, default=0, help="DB_SHARDS for the run")
+    ap.add_argument("--unsafe", action="store_true", help="SHARED_DB off: show what breaks without it")
+    a = ap.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="dot-bench-"), "shared.db")
+    os.environ.update(TELEGRAM_TOKEN=os.environ.get("TELEGRAM_TOKEN", "0:bench"),
+                      ADMIN_ID=os.environ.get("ADMIN_ID", "1"), DB_PATH=path,
+                      SHARED_DB="0" if a.unsafe else "1", DB_SHARDS=str(a.shards),
+                      MAX_REROLL_PER_PLAYER=str(10**6))
+    import main
+    main.init_db()
+    gids = []
+    for i in range(a.games):
+        gid = main.create_group_game(-1_000_000-i, 1, 1)
+        for k in range(1, a.players+1):
+            main.upsert_player(gid, gid*100+k, f"p{gid*100+k}")
+        main.start_game(gid)
+        gids.append(gid)
+    main.CACHE.flush()
+
+    ctx = multiprocessing.get_context("spawn")
+    t = time.perf_counter()
+    with ctx.Pool(a.procs) as pool:
+        results = pool.map(worker, [(w, a.ops, gids, a.seed) for w in range(a.procs)])
+    elapsed = time.perf_counter()-t
+
+    moves = collections.defaultdict(list)
+    stats = collections.Counter()
+    for m, s, _ in results:
+        for k, v in m.items():
+            moves[k] += v
+        stats.update(s)
+    advanced = moves["advanced"]
+    count = {k: collections.Counter(v) for k, v in moves.items() if k != "advanced"}
+    print(f"{a.procs} processes x {a.ops} ops on {a.games} games, SHARED_DB={'0' if a.unsafe else '1'}, "
+          f"{a.shards or 'no'} shards: "
+          f"{elapsed:.2f}s, {len(advanced)} turns ({len(advanced)/elapsed:.0f}/s)")
+    print(f"moves: {', '.join(f'{k} {sum(c.values())}' for k, c in count.items())}")
+    print(f"CAS: {dict(stats)}")
+
+    conns = {}
+    for gid in gids:
+        conns[gid] = sqlite3.connect(main.game_pool(gid).path)
+        conns[gid].row_factory = sqlite3.Row
+    froms = collections.Counter(advanced)
+    per_game = collections.Counter(gid for gid, _ in advanced)
+    doubles = sum(n-1 for n in froms.values() if n > 1)
+    lost = acts = bad = spent = ring = 0
+    for gid in gids:
+        conn = conns[gid]
+        idx = conn.execute("SELECT current_turn_index FROM games WHERE id=?;", (gid,)).fetchone()[0]
+        lost += abs(idx-per_game[gid]) + sum(1 for i in range(idx) if (gid, i) not in froms)
+        st = dict(conn.execute("SELECT status, COUNT(*) FROM actions WHERE game_id=? AND qtype='stress' "
+                               "GROUP BY status;", (gid,)).fetchall())
+        acts += sum(st.values()) != count.get("pick", {}).get(gid, 0)
+        bad += (st.get("done_wait", 0)+st.get("confirmed", 0) != count.get("done", {}).get(gid, 0)
+                or st.get("confirmed", 0) != per_game[gid])
+        left = conn.execute("SELECT COUNT(*), SUM(rerolls_left) FROM game_players WHERE game_id=?;", (gid,)).fetchone()
+        spent += left[0]*10**6-left[1] != count.get("reroll", {}).get(gid, 0)
+        ring += not check_ring(conn, gid)
+    checks = [("no errors", stats["errors"] == 0, f"{stats['errors']} operation(s) raised"),
+              ("no double advance", doubles == 0, f"{doubles} turn(s) advanced twice"),
+              ("no lost turn", lost == 0, f"{lost} mismatch(es) between turn index and transitions"),
+              ("actions", acts == 0, f"{acts} game(s) with a wrong action count"),
+              ("moves", bad == 0, f"{bad} game(s) with a move applied twice or out of phase"),
+              ("rerolls", spent == 0, f"{spent} game(s) with a wrong reroll count"),
+              ("ring", ring == 0, f"{ring} game(s) with a broken turn ring")]
+    for name, ok, why in checks:
+        print(f"{name:18} {'PASS' if ok else 'FAIL: '+why}")
+    sys.exit(0 if all(ok for _, ok, _ in checks) else 1)
+
+
+if __name__ == "__main__":
+    cli()
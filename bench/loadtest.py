@@ -0,0 +1,274 @@
+"""End-to-end load test: many games clicking through build_app() against a fake Telegram.
+
+    python bench/loadtest.py [--groups 50] [--inline 50] [--rounds 20] [--players 4]
+                             [--think-ms 0] [--api-delay-ms 0] [--retry-after-rate 0]
+                             [--no-limits] [--seed 1]
+
+The Application comes from build_app(request=...) with a stand-in transport in
+place of api.telegram.org. Updates are put on app.update_queue of the started
+Application, so they go through PTB's update fetcher, the GameOrderedProcessor
+build_app installs (lanes, worker and lane limits), handlers, Bot serialization
+and our outbound scheduler. The transport records every Bot
+API call, can add latency, and can answer sends/edits with 429 RetryAfter.
+
+Group games start with /startgame and players joining; inline games with two
+players joining and starting. Every game then plays `rounds` turns concurrently:
+pick + done (+ confirm for inline), skip or refuse. Reported per callback:
+latency from update_queue.put until every handler group ran, SQL statements executed (including the
+write-behind flushes) and Bot API calls (including coalesced board edits,
+counted after the edit queue drains).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import tempfile
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+main = None  # imported in cli() once the environment is set
+
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs)-1, int(len(xs)*p))] if xs else 0.0
+
+
+class FakeTelegram(BaseRequest):
+    """Answers Bot API requests locally and counts them per method."""
+    LIMITED = ("sendMessage", "editMessageText", "editMessageReplyMarkup")
+
+    def __init__(self, delay_ms=0.0, retry_after_rate=0.0, retry_after=1, seed=1):
+        self.delay = delay_ms/1000.0
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = collections.Counter()
+        self.retry_after_sent = 0
+        self._mid = itertools.count(10_000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id, message_id=None, text=""):
+        chat_id = int(chat_id)
+        return {"message_id": message_id or next(self._mid), "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}}
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "sendMessage":
+            return self._message(params["chat_id"], text=params.get("text", ""))
+        if method in ("editMessageText", "editMessageReplyMarkup"):
+            if "inline_message_id" in params:
+                return True
+            return self._message(params["chat_id"], int(params["message_id"]), params.get("text", ""))
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[name] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay*self.rng.uniform(0.5, 1.5))
+        if name in self.LIMITED and self.rng.random() < self.retry_after_rate:
+            self.retry_after_sent += 1
+            body = {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}}
+            return 429, json.dumps(body).encode()
+        return 200, json.dumps({"ok": True, "result": self._result(name, params)}).encode()
+
+
+class Load:
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.ids = itertools.count(1)
+        self.lat = []
+        self.pending = {}  # update_id -> future set once the update has been handled
+
+    async def handled(self, update, context):
+        """Last handler group: every handler of the update has run."""
+        fut = self.pending.pop(update.update_id, None)
+        if fut is not None:
+            fut.set_result(None)
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+    async def _feed(self, data, measure=True):
+        upd = Update.de_json(data, self.app.bot)
+        fut = self.pending[upd.update_id] = asyncio.get_running_loop().create_future()
+        t = time.perf_counter()
+        await self.app.update_queue.put(upd)
+        await fut
+        if measure:
+            self.lat.append((time.perf_counter()-t)*1000)
+
+    async def command(self, chat_id, uid, text):
+        await self._feed({"update_id": next(self.ids), "message": {
+            "message_id": next(self.ids), "date": int(time.time()), "text": text, "from": self._user(uid),
+            "chat": {"id": chat_id, "type": "supergroup"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]}}, measure=False)
+
+    async def click(self, uid, data, chat_id=None, message_id=1, inline=None):
+        cq = {"id": str(next(self.ids)), "from": self._user(uid), "chat_instance": "bench", "data": data}
+        if inline:
+            cq["inline_message_id"] = inline
+        else:
+            cq["message"] = {"message_id": message_id, "date": int(time.time()),
+                             "chat": {"id": chat_id, "type": "supergroup"}}
+        await self._feed({"update_id": next(self.ids), "callback_query": cq})
+        if self.args.think_ms:
+            await asyncio.sleep(self.rng.expovariate(1000.0/self.args.think_ms))
+
+    async def group_game(self, i):
+        chat = -1_000_000-i
+        uids = [i*100+k for k in range(1, self.args.players+1)]
+        await self.command(chat, uids[0], "/startgame")
+        g = main.get_group_game_by_chat(chat)
+        gid, mid = g["id"], g["board_message_id"]
+        tap = lambda uid, action: self.click(uid, f"g{gid}:{action}", chat_id=chat, message_id=mid)
+        for uid in uids[1:]:
+            await tap(uid, "join")
+        await tap(uids[0], "start")
+        await self.play(gid, tap, None)
+
+    async def inline_game(self, i):
+        im = f"bench-{i}"
+        uids = [500_000+i*2, 500_001+i*2]
+        for uid in uids:
+            await self.click(uid, "new:join", inline=im)
+        await self.click(uids[0], "new:start", inline=im)
+        gid = main.get_game_by_inline_id(im)["id"]
+        tap = lambda uid, action: self.click(uid, f"g{gid}:{action}", inline=im)
+        await self.play(gid, tap, uids)
+
+    async def play(self, gid, tap, pair):
+        for _ in range(self.args.rounds):
+            g = main.get_game(gid)
+            cp = main.current_player(g) if g else None
+            if not cp:
+                return
+            uid = int(cp["user_id"])
+            r = self.rng.random()
+            if r < 0.7:
+                await tap(uid, f"pick:{self.rng.choice(('truth', 'dare'))}:normal")
+                await tap(uid, "done")
+                if pair:
+                    other = pair[1] if uid == pair[0] else pair[0]
+                    await tap(other, f"confirm:{'yes' if self.rng.random() < 0.8 else 'no'}")
+            elif r < 0.85:
+                await tap(uid, "skip")
+            else:
+                await tap(uid, "refuse")
+
+
+async def drain(timeout=120.0):
+    t = time.perf_counter()
+    while time.perf_counter()-t < timeout:
+        busy = any(rt.edit is not None for rt in main.RUNTIME.games.values())
+        if not busy and not main.LIMITER.waiters:
+            break
+        await asyncio.sleep(0.05)
+    await main.run_db(main.CACHE.flush)
+    return time.perf_counter()-t
+
+
+SQL = {"statements": 0}
+
+
+def count_sql():
+    """Trace every statement on pooled connections, shards included (install before the first connection opens)."""
+    for pool in [main.POOL]+main.SHARDS:
+        def traced_connect(connect=pool._connect):
+            conn = connect()
+            def trace(_sql):
+                SQL["statements"] += 1
+            conn.set_trace_callback(trace)
+            return conn
+        pool._connect = traced_connect
+
+
+async def run(args):
+    count_sql()
+    transport = FakeTelegram(args.api_delay_ms, args.retry_after_rate, seed=args.seed)
+    app = main.build_app(request=transport)
+    load = Load(app, args)
+    app.add_handler(TypeHandler(Update, load.handled), group=1)
+    await app.initialize()
+    await main.on_startup(app)
+    await app.start()
+    SQL["statements"] = 0
+
+    t = time.perf_counter()
+    await asyncio.gather(*[load.group_game(i) for i in range(args.groups)],
+                         *[load.inline_game(i) for i in range(args.inline)])
+    elapsed = time.perf_counter()-t
+    drained = await drain()
+
+    n = len(load.lat)
+    api = sum(v for k, v in transport.calls.items() if k != "getMe")
+    print(f"{args.groups} group + {args.inline} inline games x {args.rounds} rounds, "
+          f"api delay {args.api_delay_ms} ms, RetryAfter rate {args.retry_after_rate}, "
+          f"limits {'off' if args.no_limits else 'on'}")
+    print(f"callbacks      {n} in {elapsed:.2f}s = {n/elapsed:.0f}/s (edit queue drained {drained:.2f}s later)")
+    print(f"latency ms     p50 {pct(load.lat, .5):.2f}  p95 {pct(load.lat, .95):.2f}  p99 {pct(load.lat, .99):.2f}  max {max(load.lat):.2f}")
+    print(f"SQL/callback   {SQL['statements']/n:.2f}  ({SQL['statements']} statements)")
+    print(f"API/callback   {api/n:.2f}  " + "  ".join(f"{k}={v}" for k, v in sorted(transport.calls.items())))
+    print(f"RetryAfter     injected={transport.retry_after_sent} limiter={main.LIMITER.stats}")
+    print(f"board edits    {main.EDIT_STATS}")
+    counts = {lv: sum(s[0]) for lv, s in main.COMMIT_BATCH.series.items()}
+    print(f"commits        {main.CACHE.flushes} ({main.CACHE.flushes/(elapsed+drained):.1f}/s)  by trigger {counts}  "
+          f"batch {main.CACHE.flushed_stmts/max(1, main.CACHE.flushes):.1f} avg, last 60s {main.WRITER.summary()}")
+
+    print(f"updates        {main.UPDATES.stats}")
+
+    await app.stop()
+    for task in app.bot_data.get("bg_tasks", []):
+        task.cancel()
+    await app.shutdown()
+
+
+def cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--groups", type=int, default=50)
+    ap.add_argument("--inline", type=int, default=50)
+    ap.add_argument("--rounds", type=int, default=20)
+    ap.add_argument("--players", type=int, default=4)
+    ap.add_argument("--think-ms", type=float, default=0.0, help="mean pause between a game's clicks")
+    ap.add_argument("--api-delay-ms", type=float, default=0.0, help="mean Bot API round trip")
+    ap.add_argument("--retry-after-rate", type=float, default=0.0, help="share of sends/edits answered with 429")
+    ap.add_argument("--no-limits", action="store_true", help="lift the outbound flood limits")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="dot-bench-"), "bench.db")
+    if args.no_limits:
+        for k in ("API_GLOBAL_PER_SEC", "API_CHAT_PER_SEC", "API_CHAT_BURST", "API_GROUP_PER_MIN", "API_GROUP_BURST"):
+            os.environ[k] = "1e9"
+    global main
+    import main as main_module
+    main = main_module
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,160 @@
+"""Micro-benchmarks for the CPU-bound helpers that run on every click.
+
+    python bench/micro.py                          # run and print
+    python bench/micro.py --save base.json         # record a baseline
+    python bench/micro.py --compare base.json      # exit 1 if anything got slower
+
+Game states are generated from fixed seeds, and every case reseeds `random`
+before it is timed, so two runs on the same machine measure the same work.
+Renders are timed on BoardSnapshots built in memory, without the game cache.
+pick_random_question runs against a scratch SQLite file grown to each bank size.
+Each case reports the best of --repeat runs in microseconds per call; --compare
+flags cases slower than the baseline by more than --threshold.
+"""
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+import platform
+import tempfile
+
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="dot-bench-"), "bench.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+SEED = 1234
+NAME_CHARS = "abcdefghijklmnopqrstuvwxyzابپتثجچحخدذرزسشصضطظعغفقکگلمنوهی <>&"
+
+
+def gen_name(rng):
+    return "".join(rng.choice(NAME_CHARS) for _ in range(rng.randint(3, 24)))
+
+
+def gen_snapshot(players, status="running", phase="choose", view="main", seed=SEED):
+    rng = random.Random(seed)
+    ps = [main.PlayerRec({"user_id": 10_000+i, "name": gen_name(rng), "rerolls_left": rng.randint(0, 3),
+                          "turns": rng.randint(0, 40), "penalties": rng.randint(0, 10),
+                          "skips_used": rng.randint(0, 10)}) for i in range(players)]
+    g = main.GameRec({"id": 4242, "kind": "group", "status": status, "phase": phase, "view": view,
+                      "allow_18": 1, "allow_mid_join": 1, "show_prev_question": 1,
+                      "last_q_text": "سوال قبلی " * 30, "turn_uid": ps[0].user_id if ps else None,
+                      "board_chat_id": -100, "board_message_id": 1, "board_inline_id": None})
+    last = ("truth", "normal", "یک سوال نسبتاً طولانی برای رندر " * 20) if phase in ("question", "wait_confirm") else None
+    return main.BoardSnapshot(g, ps, ps[0] if ps else None, ps[0] if ps else None, last)
+
+
+def gen_paste(lines, seed=SEED):
+    rng = random.Random(seed)
+    styles = ("{n}) {t}", "{n} - {t}", "{n}. {t}", "{n}= {t}", "{t}", "  {t}  ")
+    out = []
+    for n in range(1, lines+1):
+        t = " ".join(gen_name(rng) for _ in range(rng.randint(3, 12)))
+        out.append(rng.choice(styles).format(n=n, t=t))
+        if rng.random() < 0.05:
+            out.append("")
+        if rng.random() < 0.05:
+            out.append(out[-1])  # duplicate
+    return "\n".join(out)
+
+
+def cases():
+    """Yield (name, zero-arg callable)."""
+    renders = [("lobby", dict(status="lobby", phase="lobby")),
+               ("choose/main", dict(phase="choose")),
+               ("choose/settings", dict(phase="choose", view="settings")),
+               ("choose/players", dict(phase="choose", view="players")),
+               ("choose/stats", dict(phase="choose", view="stats")),
+               ("question", dict(phase="question")),
+               ("wait_confirm", dict(phase="wait_confirm")),
+               ("ended", dict(status="ended"))]
+    for name, kw in renders:
+        s = gen_snapshot(8, **kw)
+        yield f"render_text/{name}/8p", lambda s=s: main.render_text(s)
+    for n in (2, 50):
+        s = gen_snapshot(n, view="players")
+        yield f"render_text/choose/players/{n}p", lambda s=s: main.render_text(s)
+
+    for name, kw in (("lobby", dict(status="lobby", phase="lobby")), ("choose", dict(phase="choose")),
+                     ("question", dict(phase="question"))):
+        s = gen_snapshot(8, **kw)
+        yield f"kb_main/{name}", lambda s=s: main.kb_main(s)
+    s = gen_snapshot(8)
+    yield "kb_settings", lambda g=s.game: main.kb_settings(g)
+
+    for n in (2, 8, 50):
+        ps = gen_snapshot(n).players
+        yield f"players_line/{n}p", lambda ps=ps: main.players_line(ps)
+
+    for n in (100, 5000):
+        text = gen_paste(n)
+        yield f"parse_bulk/{n}_lines", lambda t=text: main.parse_bulk(t)
+
+    datas = ["g12:join", "g123456:pick:truth:normal", "g9:view:settings", "g77:confirm:yes", "new:join", "adm:ap:5"]
+    yield "parse_callback/mix", lambda: [main.parse_callback(d) for d in datas]
+
+    main.init_db()
+    main.seed_if_empty()
+    rng = random.Random(SEED)
+    have = len(main.SAMPLER.snapshot("truth", "normal"))
+    for size in (100, 10_000, 100_000):
+        if size > have:
+            main.add_questions("truth", "normal", [f"q{i} {gen_name(rng)}" for i in range(have, size)])
+            have = size
+        yield f"pick_random_question/{size}", lambda: main.pick_random_question("truth", "normal")
+        yield f"sampler.pick/{size}", lambda: main.SAMPLER.pick("truth", "normal")
+
+
+def measure(fn, repeat):
+    random.seed(SEED)
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best/number*1e6
+
+
+def cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--save", metavar="PATH", help="write results as a baseline")
+    ap.add_argument("--compare", metavar="PATH", help="compare against a saved baseline")
+    ap.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown before a case fails")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("-k", dest="filter", default="", help="only cases whose name contains this")
+    a = ap.parse_args()
+
+    base = {}
+    if a.compare:
+        with open(a.compare, encoding="utf-8") as f:
+            base = json.load(f)["results"]
+
+    results, slower = {}, []
+    print(f"{'case':40} {'us/call':>10}" + (f" {'base':>10} {'change':>8}" if base else ""))
+    for name, fn in cases():
+        if a.filter not in name:
+            continue
+        us = results[name] = measure(fn, a.repeat)
+        line = f"{name:40} {us:10.2f}"
+        if name in base:
+            change = us/base[name]-1
+            line += f" {base[name]:10.2f} {change:+8.1%}"
+            if change > a.threshold:
+                slower.append(name)
+                line += "  SLOWER"
+        print(line)
+
+    if a.save:
+        with open(a.save, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "seed": SEED, "results": results}, f, indent=1, sort_keys=True)
+        print(f"baseline saved to {a.save}")
+    if slower:
+        print(f"{len(slower)} case(s) slower than baseline by more than {a.threshold:.0%}: {', '.join(slower)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
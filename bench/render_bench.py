@@ -0,0 +1,98 @@
+"""Cost of rendering one board: store lookups, SQL statements, allocations, time.
+
+    python bench/render_bench.py [--players 8] [--iters 2000]
+
+Drives render_board() (what edit_board runs per edit) for every view and
+phase of a running game with a warm game cache. "lookups" counts calls into
+the game-state read helpers, "sql" the statements SQLite actually executed,
+"peak KiB" the transient memory one render allocates (tracemalloc peak).
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="dot-bench-"), "bench.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+READERS = ("get_game", "list_players", "player_row", "current_player", "last_action", "load_snapshot")
+COUNTS = {"lookups": 0, "sql": 0}
+
+
+def instrument():
+    for name in READERS:
+        fn = getattr(main, name, None)
+        if fn is None:
+            continue
+        def counted(*a, _fn=fn, **kw):
+            COUNTS["lookups"] += 1
+            return _fn(*a, **kw)
+        setattr(main, name, counted)
+    connect = main.POOL._connect
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(lambda _sql: COUNTS.__setitem__("sql", COUNTS["sql"]+1))
+        return conn
+    main.POOL._connect = traced_connect
+
+
+def setup(players):
+    main.init_db()
+    main.seed_if_empty()
+    main.CACHE.rebuild()
+    gid = main.create_group_game(-100, 1, 1)
+    for uid in range(1, players+1):
+        main.upsert_player(gid, uid, f"player {uid}")
+    main.start_game(gid)
+    return gid
+
+
+def scenarios(gid):
+    yield "lobby/main", dict(status="lobby", phase="lobby", view="main")
+    for view in ("main", "settings", "players", "stats"):
+        yield f"choose/{view}", dict(status="running", phase="choose", view=view)
+    yield "question/main", dict(status="running", phase="question", view="main")
+    yield "wait_confirm/main", dict(status="running", phase="wait_confirm", view="main")
+
+
+def run(gid, iters):
+    main.create_action(gid, 1, "truth", "normal", "چه سوالی؟ " * 20, "asked")
+    main.set_game_fields(gid, last_q_text="چه سوالی؟ " * 20)
+    main.CACHE.flush()
+    print(f"{'scenario':18} {'lookups':>8} {'sql':>5} {'peak KiB':>9} {'us/render':>10}")
+    for name, fields in scenarios(gid):
+        main.set_game_fields(gid, **fields)
+        main.CACHE.flush()
+        main.render_board(gid, 1)  # warm
+        COUNTS["lookups"] = COUNTS["sql"] = 0
+        tracemalloc.start()
+        base=tracemalloc.get_traced_memory()[0]
+        main.render_board(gid, 1)
+        kib=(tracemalloc.get_traced_memory()[1]-base)/1024
+        tracemalloc.stop()
+        lookups, sql = COUNTS["lookups"], COUNTS["sql"]
+        t = time.perf_counter()
+        for _ in range(iters):
+            main.render_board(gid, 1)
+        us = (time.perf_counter()-t)/iters*1e6
+        print(f"{name:18} {lookups:8d} {sql:5d} {kib:9.1f} {us:10.1f}")
+
+
+def cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--players", type=int, default=8)
+    ap.add_argument("--iters", type=int, default=2000)
+    a = ap.parse_args()
+    instrument()
+    gid = setup(a.players)
+    run(gid, a.iters)
+
+
+if __name__ == "__main__":
+    cli()
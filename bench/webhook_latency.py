@@ -0,0 +1,196 @@
+"""Update-to-handler latency: webhook receiver vs long polling, against a simulated Telegram.
+
+    python bench/webhook_latency.py [--updates 2000] [--rate 200] [--rtt-ms 40]
+                                    [--connections 40] [--seed 1]
+
+Synthetic updates (private text messages) "arrive at Telegram" as a Poisson
+stream of --rate per second. Latency is measured from that arrival to the
+first handler seeing the update (a TypeHandler in group -1 of build_app()).
+
+  webhook  Telegram-side senders, one keep-alive connection each (up to
+           --connections, like setWebhook max_connections), POST each update
+           to WebhookReceiver over loopback after rtt/2 and wait for the 200.
+  polling  app.updater long-polls a fake getUpdates that holds the request
+           until updates are pending; request and response each take rtt/2.
+
+Both modes share one Application; only the update source differs. The run
+also checks that a wrong secret is refused with 403.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+
+import loadtest  # noqa: E402
+from loadtest import FakeTelegram, pct  # noqa: E402
+
+main = None  # imported in cli() once the environment is set
+SECRET = "bench-secret"
+PATH = "/hook"
+
+
+class PollingTelegram(FakeTelegram):
+    """FakeTelegram whose getUpdates long-polls a local backlog."""
+
+    def __init__(self, rtt, **kw):
+        super().__init__(**kw)
+        self.half = rtt/2
+        self.backlog = collections.deque()
+        self.arrived = asyncio.Event()
+        self.polls = 0
+
+    def push(self, update):
+        self.backlog.append(update)
+        self.arrived.set()
+
+    async def do_request(self, url, method, request_data=None, **kw):
+        if not url.endswith("/getUpdates"):
+            return await super().do_request(url, method, request_data, **kw)
+        params = request_data.parameters if request_data else {}
+        self.polls += 1
+        await asyncio.sleep(self.half)
+        offset = int(params.get("offset") or 0)
+        while self.backlog and self.backlog[0]["update_id"] < offset:
+            self.backlog.popleft()
+        if not self.backlog:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        batch = list(self.backlog)[:int(params.get("limit") or 100)]
+        await asyncio.sleep(self.half)
+        return 200, json.dumps({"ok": True, "result": batch}).encode()
+
+
+def make_update(uid, n):
+    return {"update_id": n, "message": {
+        "message_id": n, "date": int(time.time()), "text": f"hello {n}",
+        "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+        "chat": {"id": uid, "type": "private"}}}
+
+
+async def arrivals(args, deliver, first_id):
+    """Generate the Poisson stream; deliver(update) hands each one to Telegram's side."""
+    rng = random.Random(args.seed)
+    sent = {}
+    for i in range(args.updates):
+        await asyncio.sleep(rng.expovariate(args.rate))
+        upd = make_update(1000+rng.randrange(500), first_id+i)
+        sent[upd["update_id"]] = time.perf_counter()
+        deliver(upd)
+    return sent
+
+
+async def post(reader, writer, body, secret=SECRET):
+    writer.write((f"POST {PATH} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+                  f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body)
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1])
+
+
+async def webhook_phase(args, app, seen, first_id):
+    receiver = main.WebhookReceiver(app, PATH, SECRET)
+    server = await receiver.start("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    assert await post(reader, writer, b"{}", secret="wrong") == 403, "bad secret accepted"
+    writer.close()
+
+    queue = asyncio.Queue()
+    async def sender():
+        r, w = await asyncio.open_connection("127.0.0.1", port)
+        while True:
+            upd = await queue.get()
+            await asyncio.sleep(args.rtt_ms/2000)
+            status = await post(r, w, json.dumps(upd).encode())
+            assert status == 200, status
+            await asyncio.sleep(args.rtt_ms/2000)
+            queue.task_done()
+    senders = [asyncio.create_task(sender()) for _ in range(args.connections)]
+    sent = await arrivals(args, queue.put_nowait, first_id)
+    await queue.join()
+    await settle(seen, sent)
+    for t in senders:
+        t.cancel()
+    receiver.close()
+    return sent
+
+
+async def polling_phase(args, app, seen, transport, first_id):
+    await app.updater.start_polling(poll_interval=0, timeout=10)
+    sent = await arrivals(args, transport.push, first_id)
+    await settle(seen, sent)
+    await app.updater.stop()
+    return sent
+
+
+async def settle(seen, sent, timeout=30.0):
+    t = time.perf_counter()
+    while any(k not in seen for k in sent) and time.perf_counter()-t < timeout:
+        await asyncio.sleep(0.01)
+
+
+def report(name, sent, seen):
+    lat = [(seen[k]-t)*1000 for k, t in sent.items() if k in seen]
+    print(f"{name:8} {len(lat):6d}/{len(sent):<6d} p50 {pct(lat, .5):7.2f}  p95 {pct(lat, .95):7.2f}  "
+          f"p99 {pct(lat, .99):7.2f}  max {max(lat, default=0):7.2f} ms")
+
+
+async def run(args):
+    transport = PollingTelegram(args.rtt_ms/1000, seed=args.seed)
+    app = main.build_app(request=FakeTelegram(seed=args.seed), get_updates_request=transport)
+    seen = {}
+    async def stamp(update, context):
+        seen.setdefault(update.update_id, time.perf_counter())
+    app.add_handler(TypeHandler(Update, stamp), group=-1)
+    await app.initialize()
+    await main.on_startup(app)
+    await app.start()
+
+    print(f"{args.updates} updates at {args.rate:.0f}/s, Telegram rtt {args.rtt_ms} ms, "
+          f"{args.connections} webhook connections")
+    sent = await webhook_phase(args, app, seen, 1)
+    report("webhook", sent, seen)
+    print(f"         receiver {main.WEBHOOK_STATS}")
+    sent = await polling_phase(args, app, seen, transport, 1+args.updates)
+    report("polling", sent, seen)
+    print(f"         getUpdates calls {transport.polls}")
+
+    await app.stop()
+    for task in app.bot_data.get("bg_tasks", []):
+        task.cancel()
+    await app.shutdown()
+
+
+def cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", type=int, default=2000)
+    ap.add_argument("--rate", type=float, default=200.0, help="updates per second arriving at Telegram")
+    ap.add_argument("--rtt-ms", type=float, default=40.0, help="round trip between Telegram and the bot")
+    ap.add_argument("--connections", type=int, default=40, help="webhook max_connections")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="dot-bench-"), "bench.db")
+    global main
+    import main as main_module
+    main = loadtest.main = main_module
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,11 +1,30 @@
 import os
 import re
+import json
+import bisect
+import heapq
+import hashlib
+import hmac
+import secrets
+import signal
+import ssl
+import itertools
+import collections
 import time
 import random
 import sqlite3
 import logging
 import asyncio
-from typing import Optional, List, Tuple
+import functools
+import contextvars
+import cProfile
+import zlib
+from array import array
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from typing import Optional, List, Tuple, Iterator
+from urllib.parse import urlsplit
 
 from telegram import (
     Update,
@@ -16,8 +35,10 @@ from telegram import (
 )
 from telegram.constants import ParseMode
 from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     InlineQueryHandler,
@@ -44,11 +65,280 @@ DB_PATH = os.getenv("DB_PATH", "data.db").strip() or "data.db"
 
 TURN_TIMEOUT_SEC = int(os.getenv("TURN_TIMEOUT_SEC", "60"))
 MAX_REROLL_PER_PLAYER = int(os.getenv("MAX_REROLL_PER_PLAYER", "3"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+# PRAGMA synchronous for every connection. FULL (default) syncs the WAL on each commit; NORMAL is faster
+# but a power loss (not a crash of the bot) can drop the last commits
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "FULL").strip().upper()
+# DB_SHARDS>0: games and their players/actions/forced questions/decks live in DB_SHARDS files
+# (data.shard0.db, ...) picked by gid; questions, suggestions, user_stats and gid allocation stay in DB_PATH
+DB_SHARDS = int(os.getenv("DB_SHARDS", "0"))
+GAME_FLUSH_SEC = float(os.getenv("GAME_FLUSH_SEC", "0.25"))
+# Group commit: queued game writes commit GAME_FLUSH_SEC after the last batch at the latest; sooner once
+# GAME_FLUSH_OPS are queued or a handler awaits durability, after GAME_COMMIT_LINGER_MS so concurrent writes join
+GAME_FLUSH_OPS = int(os.getenv("GAME_FLUSH_OPS", "256"))
+GAME_COMMIT_LINGER_MS = float(os.getenv("GAME_COMMIT_LINGER_MS", "5"))
+# Several bot processes on one data.db: game changes commit at once as compare-and-swap on games.version
+SHARED_DB = int(os.getenv("SHARED_DB", "0"))
+CAS_RETRIES = int(os.getenv("CAS_RETRIES", "8"))
+EDIT_DEBOUNCE_SEC = float(os.getenv("EDIT_DEBOUNCE_SEC", "0.1"))
+RUNTIME_IDLE_TTL_SEC = float(os.getenv("RUNTIME_IDLE_TTL_SEC", "1800"))
+RUNTIME_SWEEP_SEC = float(os.getenv("RUNTIME_SWEEP_SEC", "60"))
+
+# Retention: ended games are rolled into games_archive after ARCHIVE_AFTER_SEC
+RETENTION_INTERVAL_SEC = float(os.getenv("RETENTION_INTERVAL_SEC", "3600"))
+ARCHIVE_AFTER_SEC = int(os.getenv("ARCHIVE_AFTER_SEC", str(7*86400)))
+FORCED_TTL_SEC = int(os.getenv("FORCED_TTL_SEC", str(86400)))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "200"))
+# Lobby/running games nobody has played for GAME_IDLE_TTL_SEC are ended (0 = never), so they leave the cache
+GAME_IDLE_TTL_SEC = int(os.getenv("GAME_IDLE_TTL_SEC", str(2*86400)))
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "2000"))
+ANALYZE_EVERY_SEC = float(os.getenv("ANALYZE_EVERY_SEC", "86400"))
+
+TOP_PAGE_SIZE = int(os.getenv("TOP_PAGE_SIZE", "10"))
+
+# Prometheus text endpoint (0 = off)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip() or "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Update dispatch: games run in parallel, one game's updates strictly in order
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))            # handlers running at once
+UPDATE_LANE_MAX = int(os.getenv("UPDATE_LANE_MAX", "32"))          # queued updates per game before intake waits
+UPDATE_PENDING_MAX = int(os.getenv("UPDATE_PENDING_MAX", "4096"))  # admitted, not yet handled, all games
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1024"))      # intake queue filled by polling / webhook
+
+# Webhook mode (WEBHOOK_URL set = webhook instead of polling). Telegram POSTs to the public
+# WEBHOOK_URL; we listen on WEBHOOK_HOST:WEBHOOK_PORT, behind a TLS proxy or with WEBHOOK_CERT/KEY.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip() or "0.0.0.0"
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "").strip() or urlsplit(WEBHOOK_URL).path or "/"
+# unset = a fresh one per start (re-registered then); workers sharing one URL (SHARED_DB) must all use the same one
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or secrets.token_urlsafe(32)
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT", "").strip()
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY", "").strip()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1 << 20)))
+
+# Per-callback tracing: callbacks slower than TRACE_SLOW_MS land in the slow log (0 = tracing off)
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "1.0"))        # share of callbacks traced (and profiled); the rest run untraced
+TRACE_PROFILE_DIR = os.getenv("TRACE_PROFILE_DIR", "").strip()  # set => cProfile dumps of the slowest callbacks
+TRACE_PROFILE_KEEP = int(os.getenv("TRACE_PROFILE_KEEP", "20"))
+
+# Bot API flood limits (global, per private/inline chat, per group)
+API_GLOBAL_PER_SEC = float(os.getenv("API_GLOBAL_PER_SEC", "25"))
+API_CHAT_PER_SEC = float(os.getenv("API_CHAT_PER_SEC", "1"))
+API_CHAT_BURST = float(os.getenv("API_CHAT_BURST", "3"))
+API_GROUP_PER_MIN = float(os.getenv("API_GROUP_PER_MIN", "20"))
+API_GROUP_BURST = float(os.getenv("API_GROUP_BURST", "5"))
+API_MAX_ATTEMPTS = int(os.getenv("API_MAX_ATTEMPTS", "5"))
+API_BUCKETS_MAX = int(os.getenv("API_BUCKETS_MAX", "2048"))
 
 if not BOT_TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN env var is required")
 if ADMIN_ID <= 0:
     raise RuntimeError("ADMIN_ID env var is required (>0)")
+if DB_SYNCHRONOUS not in ("OFF","NORMAL","FULL","EXTRA"):
+    raise RuntimeError("DB_SYNCHRONOUS must be OFF, NORMAL, FULL or EXTRA")
+if WEBHOOK_URL and SHARED_DB and not os.getenv("WEBHOOK_SECRET", "").strip():
+    raise RuntimeError("WEBHOOK_SECRET is required with WEBHOOK_URL and SHARED_DB (every worker must register the same one)")
+
+# =========================
+# Metrics (Prometheus text format)
+# =========================
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Fixed-bucket histogram, one series per label value.
+
+    observe() is a bisect and two increments; each histogram is written from a
+    single thread (event loop or DB thread), so it takes no lock.
+    """
+    __slots__=("name","help","label","buckets","series")
+    def __init__(self, name: str, help: str, label: str, buckets: Tuple[float, ...]=LATENCY_BUCKETS):
+        self.name=name; self.help=help; self.label=label; self.buckets=buckets
+        self.series={}  # label value -> [bucket counts (+Inf last), sum]
+
+    def observe(self, lv: str, value: float):
+        s=self.series.get(lv)
+        if s is None:
+            s=self.series[lv]=[[0]*(len(self.buckets)+1), 0.0]
+        s[0][bisect.bisect_left(self.buckets, value)]+=1
+        s[1]+=value
+
+    def expose(self, out: List[str]):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} histogram")
+        for lv, (counts, total) in sorted(self.series.items()):
+            acc=0
+            for le, c in zip(self.buckets, counts):
+                acc+=c
+                out.append(f'{self.name}_bucket{{{self.label}="{lv}",le="{le}"}} {acc}')
+            acc+=counts[-1]
+            out.append(f'{self.name}_bucket{{{self.label}="{lv}",le="+Inf"}} {acc}')
+            out.append(f'{self.name}_sum{{{self.label}="{lv}"}} {total:.6f}')
+            out.append(f'{self.name}_count{{{self.label}="{lv}"}} {acc}')
+
+class Counter:
+    __slots__=("name","help","label","values")
+    def __init__(self, name: str, help: str, label: str):
+        self.name=name; self.help=help; self.label=label
+        self.values={}
+
+    def inc(self, lv: str, n: int=1):
+        self.values[lv]=self.values.get(lv,0)+n
+
+    def expose(self, out: List[str]):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} counter")
+        for lv, v in sorted(self.values.items()):
+            out.append(f'{self.name}{{{self.label}="{lv}"}} {v}')
+
+CALLBACK_SECONDS = Histogram("dot_callback_seconds", "callback_router handling time by action.", "action")
+DB_SECONDS = Histogram("dot_db_seconds", "Time a DB helper ran on the DB thread.", "helper")
+QUEUE_SECONDS = Histogram("dot_db_queue_seconds", "Wait for the DB thread before a helper started.", "helper")
+BOARD_EDIT_SECONDS = Histogram("dot_board_edit_seconds", "Render + edit of one board (_send_board) by result.", "result")
+TG_EDIT_SECONDS = Histogram("dot_telegram_edit_seconds", "editMessageText round trip incl. retries (_edit_message_safe).", "kind")
+UPDATE_WAIT_SECONDS = Histogram("dot_update_wait_seconds", "Admission to handler start (lane + worker wait) by lane kind.", "kind")
+COMMIT_BATCH = Histogram("dot_commit_batch_statements", "Statements per game-cache commit by trigger.", "trigger", BATCH_BUCKETS)
+API_ERRORS = Counter("dot_api_errors_total", "Bot API errors and fallbacks by kind.", "kind")
+
+# =========================
+# Tracing (هر کال‌بک: کوئری‌ها، کال‌های API، زمان کل)
+# =========================
+class Trace:
+    """What one callback spent its time on. Filled from the event loop and the DB thread."""
+    __slots__=("action","gid","t0","total","sql","api","done")
+    def __init__(self, action: str, gid: Optional[int]):
+        self.action=action; self.gid=gid
+        self.t0=time.perf_counter(); self.total=0.0
+        self.sql=[]   # [(statement, seconds)]
+        self.api=[]   # [(method, seconds)]
+        self.done=False
+
+    def summary(self) -> str:
+        sql_t=sum(d for _,d in self.sql); api_t=sum(d for _,d in self.api)
+        top=sorted(self.sql+self.api, key=lambda x: -x[1])[:3]
+        return (f"{self.action} gid={self.gid} {self.total*1000:.1f}ms | sql {len(self.sql)} {sql_t*1000:.1f}ms"
+                f" | api {len(self.api)} {api_t*1000:.1f}ms | slowest: "
+                + "; ".join(f"{s} {d*1000:.1f}ms" for s,d in top))
+
+TRACE: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+TRACE_STATS = {"traced": 0, "slow": 0, "profiles": 0}
+SLOW_LOG = collections.deque(maxlen=50)
+slow_log = logging.getLogger("jorathaghighatpro.slow")
+
+def _sql_head(sql: str) -> str:
+    return " ".join(sql.split())[:80]
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        tr=TRACE.get()
+        if tr is None or tr.done:
+            return super().execute(sql, params)
+        t=time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            tr.sql.append((_sql_head(sql), time.perf_counter()-t))
+
+    def executemany(self, sql, seq):
+        tr=TRACE.get()
+        if tr is None or tr.done:
+            return super().executemany(sql, seq)
+        t=time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            tr.sql.append((_sql_head(sql), time.perf_counter()-t))
+
+class TracedConnection(sqlite3.Connection):
+    """Times statements (conn.execute and explicit cursors) while a trace is active."""
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        tr=TRACE.get()
+        if tr is None or tr.done:
+            return super().execute(sql, params)
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        tr=TRACE.get()
+        if tr is None or tr.done:
+            return super().executemany(sql, seq)
+        return self.cursor().executemany(sql, seq)
+
+class TracedRequest(BaseRequest):
+    """Wraps the Bot API transport and records each call on the active trace."""
+    def __init__(self, inner: BaseRequest):
+        self.inner=inner
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        tr=TRACE.get()
+        if tr is None or tr.done:
+            return await self.inner.do_request(url, method, request_data, **timeouts)
+        t=time.perf_counter()
+        try:
+            return await self.inner.do_request(url, method, request_data, **timeouts)
+        finally:
+            tr.api.append((url.rsplit("/",1)[-1], time.perf_counter()-t))  # never log the token-bearing url
+
+class SlowProfiler:
+    """cProfile of one callback at a time; keeps the TRACE_PROFILE_KEEP slowest dumps on disk.
+
+    The profile covers the event loop thread while the callback runs, so
+    coroutines of other updates that interleave with it show up too; its DB
+    work runs on the DB thread and is covered by the SQL timings instead.
+    """
+    def __init__(self):
+        self.active=False
+        self.kept=[]  # heap [(seconds, path)]
+
+    def start(self) -> Optional[cProfile.Profile]:
+        if not TRACE_PROFILE_DIR or self.active:
+            return None
+        self.active=True
+        prof=cProfile.Profile()
+        prof.enable()
+        return prof
+
+    def stop(self, prof: cProfile.Profile, tr: Trace, slow: bool):
+        prof.disable()
+        self.active=False
+        if not slow or (len(self.kept)>=TRACE_PROFILE_KEEP and tr.total<=self.kept[0][0]):
+            return
+        os.makedirs(TRACE_PROFILE_DIR, exist_ok=True)
+        path=os.path.join(TRACE_PROFILE_DIR, f"{int(time.time())}-{tr.action}-{tr.gid}-{int(tr.total*1000)}ms.prof")
+        prof.dump_stats(path)
+        TRACE_STATS["profiles"]+=1
+        heapq.heappush(self.kept, (tr.total, path))
+        if len(self.kept)>TRACE_PROFILE_KEEP:
+            _, old = heapq.heappop(self.kept)
+            try: os.remove(old)
+            except OSError: pass
+
+PROFILER = SlowProfiler()
+
+def trace_finish(tr: Trace, prof: Optional[cProfile.Profile]):
+    tr.total=time.perf_counter()-tr.t0
+    tr.done=True
+    TRACE_STATS["traced"]+=1
+    slow=tr.total*1000>=TRACE_SLOW_MS
+    if prof is not None:
+        PROFILER.stop(prof, tr, slow)
+    if slow:
+        TRACE_STATS["slow"]+=1
+        line=tr.summary()
+        SLOW_LOG.append(line)
+        slow_log.warning("slow callback %s", line)
 
 # =========================
 # DB
@@ -56,16 +346,144 @@ if ADMIN_ID <= 0:
 def now() -> int:
     return int(time.time())
 
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+class DBPool:
+    """Bounded pool of long-lived SQLite connections.
+
+    Connections keep their prepared-statement cache between checkouts, so hot
+    helpers pay neither the connect/teardown cost nor the re-prepare cost.
+    """
+    def __init__(self, path: str, size: int=4, cached_statements: int=256):
+        self.path=path
+        self.size=size
+        self.cached_statements=cached_statements
+        self._idle: List[sqlite3.Connection]=[]
+        self._lock=threading.Lock()
+        self._slots=threading.BoundedSemaphore(size)
+        self.opened=0
+        self.reused=0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn=sqlite3.connect(self.path, check_same_thread=False, cached_statements=self.cached_statements,
+                             factory=TracedConnection)
+        conn.row_factory=sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS};")
+        conn.execute("PRAGMA busy_timeout=5000;")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        self._slots.acquire()
+        conn=None
+        try:
+            with self._lock:
+                if self._idle:
+                    conn=self._idle.pop()
+                    self.reused+=1
+            if conn is None:
+                conn=self._connect()
+                with self._lock:
+                    self.opened+=1
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                try:
+                    conn.rollback()
+                except Exception:
+                    # broken connection: drop it instead of returning it to the pool
+                    conn.close(); conn=None
+                raise
+        finally:
+            if conn is not None:
+                with self._lock:
+                    self._idle.append(conn)
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size":self.size,"idle":len(self._idle),"opened":self.opened,"reused":self.reused}
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
 
-def init_db() -> None:
-    conn = db()
-    cur = conn.cursor()
+POOL = DBPool(DB_PATH, DB_POOL_SIZE)
+
+def shard_path(n: int) -> str:
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}.shard{n}{ext or '.db'}"
+
+SHARDS = [DBPool(shard_path(n), DB_POOL_SIZE) for n in range(DB_SHARDS)]
+# one writer thread per shard, so a flush commits the shards' batches side by side
+SHARD_EXECUTORS = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard{n}") for n in range(DB_SHARDS)]
+GAME_TABLES = (("games","id"), ("game_players","game_id"), ("actions","game_id"),
+               ("forced_questions","game_id"), ("game_decks","game_id"), ("games_archive","game_id"))
+
+def db():
+    """Check out a pooled connection: `with db() as conn:`; commits on exit, rolls back on error."""
+    return POOL.connection()
+
+def shard_of(gid: Optional[int]) -> Optional[int]:
+    """Shard holding game gid's rows; None = DB_PATH (no sharding, or not a per-game write)."""
+    return gid % DB_SHARDS if SHARDS and gid is not None else None
 
-    cur.execute("""
+def game_pool(gid: int) -> DBPool:
+    return SHARDS[gid % DB_SHARDS] if SHARDS else POOL
+
+def gdb(gid: int):
+    """Like db(), on the file holding game gid's rows."""
+    return game_pool(gid).connection()
+
+def game_pools() -> List[DBPool]:
+    """Every file with game rows, for cross-shard scans."""
+    return SHARDS or [POOL]
+
+def _write_batch(pool: DBPool, batch: List[tuple]):
+    with pool.connection() as conn:
+        for sql, params in batch:
+            conn.execute(sql, params)
+
+def write_batches(groups: dict) -> dict:
+    """Commit {shard_of(): [(sql, params)]}, one transaction per file; shards run on their
+    writer threads in parallel with DB_PATH's batch here. Returns {key: exception} for failed groups."""
+    futs={k: SHARD_EXECUTORS[k].submit(_write_batch, SHARDS[k], b) for k,b in groups.items() if k is not None}
+    errors={}
+    if None in groups:
+        try:
+            _write_batch(POOL, groups[None])
+        except Exception as e:
+            errors[None]=e
+    for k, f in futs.items():
+        try:
+            f.result()
+        except Exception as e:
+            errors[k]=e
+    return errors
+
+def _backfill_turn_ring(conn: sqlite3.Connection):
+    # link the active players of every open game in join order and keep whoever
+    # current_turn_index % len(players) pointed at as the current player
+    games=conn.execute("SELECT id,current_turn_index FROM games WHERE status IN ('lobby','running');").fetchall()
+    for g in games:
+        uids=[int(r["user_id"]) for r in conn.execute(
+            "SELECT user_id FROM game_players WHERE game_id=? AND active=1 ORDER BY joined_at, id;",(g["id"],))]
+        n=len(uids)
+        for i,uid in enumerate(uids):
+            conn.execute("UPDATE game_players SET prev_uid=?, next_uid=? WHERE game_id=? AND user_id=?;",
+                         (uids[i-1], uids[(i+1)%n], g["id"], uid))
+        if n:
+            conn.execute("UPDATE games SET turn_uid=? WHERE id=?;",(uids[int(g["current_turn_index"])%n], g["id"]))
+
+# Schema migrations: MIGRATIONS[n] upgrades user_version n -> n+1. A step is a
+# list of SQL strings and/or callables taking the connection.
+# Append new steps only; never edit a step that has shipped.
+MIGRATIONS: List[list] = [
+  # 1: baseline tables (IF NOT EXISTS so pre-migration data.db files upgrade in place)
+  [
+    """
     CREATE TABLE IF NOT EXISTS questions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         qtype TEXT NOT NULL,
@@ -74,9 +492,8 @@ def init_db() -> None:
         enabled INTEGER NOT NULL DEFAULT 1,
         created_at INTEGER NOT NULL
     );
-    """)
-
-    cur.execute("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS suggestions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
@@ -89,9 +506,8 @@ def init_db() -> None:
         reviewed_by INTEGER,
         reviewed_at INTEGER
     );
-    """)
-
-    cur.execute("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS games (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         kind TEXT NOT NULL,               -- group | inline
@@ -117,9 +533,8 @@ def init_db() -> None:
         last_qtype TEXT DEFAULT '',
         last_level TEXT DEFAULT ''
     );
-    """)
-
-    cur.execute("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS game_players (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         game_id INTEGER NOT NULL,
@@ -133,9 +548,8 @@ def init_db() -> None:
         active INTEGER NOT NULL DEFAULT 1,
         UNIQUE(game_id, user_id)
     );
-    """)
-
-    cur.execute("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS actions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         game_id INTEGER NOT NULL,
@@ -146,9 +560,8 @@ def init_db() -> None:
         status TEXT NOT NULL,     -- asked/done_wait/confirmed/rejected/refused/timeout
         created_at INTEGER NOT NULL
     );
-    """)
-
-    cur.execute("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS forced_questions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         game_id INTEGER NOT NULL,
@@ -158,10 +571,190 @@ def init_db() -> None:
         text TEXT NOT NULL,
         created_at INTEGER NOT NULL
     );
-    """)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS game_decks (
+        game_id INTEGER NOT NULL,
+        qtype TEXT NOT NULL,
+        level TEXT NOT NULL,
+        deck BLOB NOT NULL,               -- shuffled question ids, packed uint32
+        pos INTEGER NOT NULL DEFAULT 0,   -- next index to draw
+        PRIMARY KEY (game_id, qtype, level)
+    );
+    """,
+  ],
+  # 2: indexes for the hot lookups
+  [
+    # list_players / cache load: WHERE game_id=? [AND active=1] ORDER BY joined_at
+    "CREATE INDEX IF NOT EXISTS idx_game_players_game ON game_players(game_id, active, joined_at);",
+    # last_action: WHERE game_id=? ORDER BY id DESC LIMIT 1
+    "CREATE INDEX IF NOT EXISTS idx_actions_game ON actions(game_id, id);",
+    # pop_forced: WHERE game_id=? AND user_id=? ORDER BY id
+    "CREATE INDEX IF NOT EXISTS idx_forced_game_user ON forced_questions(game_id, user_id, id);",
+    # get_group_game_by_chat: WHERE kind='group' AND board_chat_id=? ORDER BY id DESC
+    "CREATE INDEX IF NOT EXISTS idx_games_chat ON games(board_chat_id, id) WHERE kind='group';",
+    # get_game_by_inline_id: one open game per inline message; older duplicates are closed first
+    """
+    UPDATE games SET status='ended' WHERE kind='inline' AND status!='ended' AND id NOT IN (
+      SELECT MAX(id) FROM games WHERE kind='inline' AND status!='ended' GROUP BY board_inline_id
+    );
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_games_inline ON games(board_inline_id) WHERE status!='ended';",
+    # cache rebuild / running_games: WHERE status IN ('lobby','running')
+    "CREATE INDEX IF NOT EXISTS idx_games_status ON games(status, id);",
+    # sampler buckets: SELECT id ... WHERE enabled=1 AND qtype=? AND level=? (covering, id is the rowid)
+    "CREATE INDEX IF NOT EXISTS idx_questions_bucket ON questions(qtype, level, enabled);",
+    # pending_suggestions: WHERE status='pending' ORDER BY id
+    "CREATE INDEX IF NOT EXISTS idx_suggestions_status ON suggestions(status, id);",
+    "ANALYZE;",
+  ],
+  # 3: persisted turn ring (games.turn_uid = current player, players doubly linked by user_id)
+  [
+    "ALTER TABLE games ADD COLUMN turn_uid INTEGER;",
+    "ALTER TABLE game_players ADD COLUMN prev_uid INTEGER;",
+    "ALTER TABLE game_players ADD COLUMN next_uid INTEGER;",
+    _backfill_turn_ring,
+  ],
+  # 4: persisted turn deadline (epoch seconds) and the player it belongs to
+  [
+    "ALTER TABLE games ADD COLUMN turn_deadline REAL;",
+    "ALTER TABLE games ADD COLUMN turn_actor INTEGER;",
+  ],
+  # 5: retention (ended_at + one compressed summary row per archived game)
+  [
+    "ALTER TABLE games ADD COLUMN ended_at INTEGER;",
+    """
+    UPDATE games SET ended_at=COALESCE((SELECT MAX(created_at) FROM actions WHERE game_id=games.id), created_at)
+    WHERE status='ended';
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS games_archive (
+        game_id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        owner_id INTEGER NOT NULL,
+        board_chat_id INTEGER,
+        created_at INTEGER NOT NULL,
+        ended_at INTEGER NOT NULL,
+        summary BLOB NOT NULL             -- zlib(JSON): players, turns, action counts
+    );
+    """,
+  ],
+  # 6: lifetime per-chat player stats (chat_id 0 = inline games), backfilled from live rows
+  [
+    """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        turns INTEGER NOT NULL DEFAULT 0,
+        penalties INTEGER NOT NULL DEFAULT 0,
+        skips INTEGER NOT NULL DEFAULT 0,
+        refusals INTEGER NOT NULL DEFAULT 0,
+        confirmations INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, user_id)
+    );
+    """,
+    # leaderboard: WHERE chat_id=? ORDER BY confirmations DESC, turns DESC, user_id, keyset-paged on that key
+    "CREATE INDEX IF NOT EXISTS idx_user_stats_rank ON user_stats(chat_id, confirmations DESC, turns DESC, user_id);",
+    """
+    INSERT OR IGNORE INTO user_stats (chat_id,user_id,name,turns,penalties,skips,refusals,confirmations,updated_at)
+    SELECT CASE WHEN g.kind='group' THEN g.board_chat_id ELSE 0 END, gp.user_id, MAX(gp.name),
+           SUM(gp.turns), SUM(gp.penalties), SUM(gp.skips_used),
+           SUM((SELECT COUNT(*) FROM actions a WHERE a.game_id=gp.game_id AND a.actor_id=gp.user_id AND a.status='refused')),
+           SUM((SELECT COUNT(*) FROM actions a WHERE a.game_id=gp.game_id AND a.actor_id=gp.user_id AND a.status='confirmed')),
+           CAST(strftime('%s','now') AS INTEGER)
+    FROM game_players gp JOIN games g ON g.id=gp.game_id
+    GROUP BY 1, 2;
+    """,
+  ],
+  # 7: optimistic concurrency: every committed game state change bumps version
+  [
+    "ALTER TABLE games ADD COLUMN version INTEGER NOT NULL DEFAULT 0;",
+  ],
+  # 8: sharding: gids come from DB_PATH's game_ids; meta pins the shard count
+  [
+    "CREATE TABLE IF NOT EXISTS game_ids (id INTEGER PRIMARY KEY AUTOINCREMENT, created_at INTEGER NOT NULL);",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);",
+  ],
+  # 9: last player activity (joins and moves, not turn timeouts) of open games, for the idle TTL
+  [
+    "ALTER TABLE games ADD COLUMN active_at INTEGER;",
+    """
+    UPDATE games SET active_at=COALESCE(
+      (SELECT MAX(created_at) FROM actions WHERE game_id=games.id AND qtype!='timeout'), created_at)
+    WHERE status!='ended';
+    """,
+  ],
+]
 
-    conn.commit()
-    conn.close()
+def _enable_incremental_vacuum(conn: sqlite3.Connection):
+    # auto_vacuum can only change on an empty file or through a full VACUUM
+    if int(conn.execute("PRAGMA auto_vacuum;").fetchone()[0])==2:
+        return
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    conn.execute("VACUUM;")
+    log.info("DB switched to incremental auto_vacuum")
+
+def init_db() -> None:
+    """Bring DB_PATH and every shard to len(MIGRATIONS); with shards, check the layout and move stray game rows."""
+    for pool in [POOL]+SHARDS:
+        _migrate(pool)
+    _distribute_games()
+
+def _migrate(pool: DBPool) -> None:
+    """Bring one file's schema to len(MIGRATIONS); no DDL runs when it is already current."""
+    with pool.connection() as conn:
+        _enable_incremental_vacuum(conn)
+        version=int(conn.execute("PRAGMA user_version;").fetchone()[0])
+        if version>=len(MIGRATIONS):
+            return
+        for step in range(version, len(MIGRATIONS)):
+            conn.execute("BEGIN IMMEDIATE;")
+            # another process sharing the file may have migrated while we waited for the lock
+            if int(conn.execute("PRAGMA user_version;").fetchone()[0])>step:
+                conn.rollback()
+                continue
+            for stmt in MIGRATIONS[step]:
+                if callable(stmt):
+                    stmt(conn)
+                else:
+                    conn.execute(stmt)
+            conn.execute(f"PRAGMA user_version={step+1};")
+            conn.commit()
+            log.info("DB schema of %s migrated to v%d", pool.path, step+1)
+
+def _distribute_games() -> None:
+    """Pin DB_SHARDS in meta and move game rows still in DB_PATH (sharding just switched on) to their shards."""
+    with db() as conn:
+        r=conn.execute("SELECT value FROM meta WHERE key='shards';").fetchone()
+        if r and int(r["value"])!=DB_SHARDS:
+            raise RuntimeError(f"games are sharded {r['value']} ways; DB_SHARDS={DB_SHARDS} would hide them (resharding is not supported)")
+        if not SHARDS:
+            return
+        conn.execute("INSERT OR REPLACE INTO meta (key,value) VALUES ('shards',?);",(str(DB_SHARDS),))
+        # new gids continue after the ones handed out before sharding
+        top=conn.execute("SELECT MAX(m) FROM (SELECT MAX(id) m FROM games UNION ALL SELECT MAX(game_id) FROM games_archive);").fetchone()[0]
+        if top and top>(conn.execute("SELECT MAX(id) FROM game_ids;").fetchone()[0] or 0):
+            conn.execute("INSERT INTO game_ids (id,created_at) VALUES (?,?);",(top,now()))
+        if not conn.execute("SELECT 1 FROM games LIMIT 1;").fetchone():
+            return
+        conn.commit()
+        for n, pool in enumerate(SHARDS):
+            conn.execute("ATTACH DATABASE ? AS shard;",(pool.path,))
+            try:
+                conn.execute("BEGIN;")
+                # same migrations on both sides => same column order; OR IGNORE makes a rerun after a crash safe
+                for table, key in GAME_TABLES:
+                    conn.execute(f"INSERT OR IGNORE INTO shard.{table} SELECT * FROM main.{table} WHERE {key} % ? = ?;",(DB_SHARDS,n))
+                conn.commit()
+            finally:
+                if conn.in_transaction: conn.rollback()
+                conn.execute("DETACH DATABASE shard;")
+        conn.execute("BEGIN;")
+        for table, _ in GAME_TABLES:
+            conn.execute(f"DELETE FROM {table};")
+        log.info("Moved existing games into %d shards", DB_SHARDS)
 
 SEED = [
     ("truth","normal","آخرین باری که به کسی دروغ گفتی کی بود و چرا؟"),
@@ -187,17 +780,15 @@ PENALTIES = [
 ]
 
 def seed_if_empty():
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS c FROM questions;")
-    c = int(cur.fetchone()["c"])
-    if c == 0:
-        cur.executemany(
-            "INSERT INTO questions (qtype, level, text, enabled, created_at) VALUES (?,?,?,?,?);",
-            [(a,b,c,1,now()) for (a,b,c) in SEED]
-        )
-        conn.commit()
-    conn.close()
+    with db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) AS c FROM questions;")
+        c = int(cur.fetchone()["c"])
+        if c == 0:
+            cur.executemany(
+                "INSERT INTO questions (qtype, level, text, enabled, created_at) VALUES (?,?,?,?,?);",
+                [(a,b,c,1,now()) for (a,b,c) in SEED]
+            )
 
 # =========================
 # Helpers
@@ -227,185 +818,1085 @@ def parse_bulk(text: str) -> List[str]:
     return res
 
 # =========================
-# Game DB operations
+# Game state cache (write-behind)
 # =========================
-def create_group_game(chat_id: int, owner_id: int, board_message_id: int) -> int:
-    conn=db(); cur=conn.cursor()
-    cur.execute("""
-      INSERT INTO games (kind,status,owner_id,board_chat_id,board_message_id,created_at)
-      VALUES ('group','lobby',?,?,?,?);
-    """,(owner_id,chat_id,board_message_id,now()))
-    gid=int(cur.lastrowid)
-    conn.commit(); conn.close()
-    return gid
-
-def get_group_game_by_chat(chat_id: int) -> Optional[sqlite3.Row]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("""
-      SELECT * FROM games WHERE kind='group' AND board_chat_id=? AND status!='ended'
-      ORDER BY id DESC LIMIT 1;
-    """,(chat_id,))
-    r=cur.fetchone(); conn.close()
-    return r
+class GameCache:
+    """Authoritative in-process copy of every non-ended game and its players.
+
+    Reads are served from memory. Mutations update memory right away and queue
+    their SQL; flush() writes the queue in one transaction per file (GAME_FLUSH_SEC
+    in the background, and before any read that has to fall through to SQLite).
+    Ended games are evicted once their final state has been flushed.
+    """
+    def __init__(self):
+        self._lock=threading.RLock()
+        self.games={}      # gid -> game dict
+        self.players={}    # gid -> {uid: player dict}, in join order
+        self.by_chat={}    # board_chat_id -> newest open group gid
+        self.by_inline={}  # board_inline_id -> gid
+        self.decks={}      # gid -> {(qtype, level): Deck}, loaded on first draw
+        self.last_actions={}  # gid -> newest action dict (or None)
+        self.pending=[]    # [(shard_of(gid), sql, params)] not yet in SQLite
+        self.in_txn=False  # inside transition(): SHARED_DB commits the txn's writes itself
+        self.queued=0      # writes ever queued; self.durable of them are committed (or were rolled back)
+        self.durable=0
+        self.forced=set()  # gids with a forced question still pending, so pop_forced flushes first
+        self.on_full=None  # called (on the writing thread) when GAME_FLUSH_OPS writes are pending
+        self.commits=collections.deque(maxlen=4096)  # (monotonic, statements) of recent commits
+        self.warm=False
+        self.flushes=0
+        self.flushed_stmts=0
+
+    def _index(self, g: dict):
+        gid=int(g["id"])
+        if g["kind"]=="group" and g["board_chat_id"] is not None:
+            chat=int(g["board_chat_id"])
+            if self.by_chat.get(chat,0)<gid:
+                self.by_chat[chat]=gid
+        elif g["kind"]=="inline" and g["board_inline_id"]:
+            self.by_inline[str(g["board_inline_id"])]=gid
+
+    def _evict(self, gid: int):
+        g=self.games.pop(gid, None)
+        self.players.pop(gid, None)
+        self.decks.pop(gid, None)
+        self.last_actions.pop(gid, None)
+        if not g:
+            return
+        if g["board_chat_id"] is not None and self.by_chat.get(int(g["board_chat_id"]))==gid:
+            chat=int(g["board_chat_id"])
+            del self.by_chat[chat]
+            for other in self.games.values():
+                if other["board_chat_id"]==chat and other["status"]!="ended": self._index(other)
+        if g["board_inline_id"] and self.by_inline.get(str(g["board_inline_id"]))==gid:
+            del self.by_inline[str(g["board_inline_id"])]
+
+    def _put(self, g: sqlite3.Row, players: List[sqlite3.Row]) -> dict:
+        gid=int(g["id"])
+        self.games[gid]=dict(g)
+        self.players[gid]={int(p["user_id"]): dict(p) for p in players}
+        self._index(self.games[gid])
+        return self.games[gid]
+
+    def rebuild(self):
+        """Reload every open game from SQLite (startup)."""
+        with self._lock:
+            self.flush()
+            games=[]; players=[]
+            for pool in game_pools():
+                with pool.connection() as conn:
+                    games+=conn.execute("SELECT * FROM games WHERE status IN ('lobby','running') ORDER BY id;").fetchall()
+                    players+=conn.execute("""
+                      SELECT gp.* FROM game_players gp JOIN games g ON g.id=gp.game_id
+                      WHERE g.status IN ('lobby','running') ORDER BY gp.joined_at, gp.id;
+                    """).fetchall()
+            games.sort(key=lambda g: g["id"])
+            by_game={}
+            for p in players:
+                by_game.setdefault(int(p["game_id"]),[]).append(p)
+            self.games.clear(); self.players.clear(); self.by_chat.clear(); self.by_inline.clear(); self.decks.clear()
+            self.last_actions.clear()
+            for g in games:
+                self._put(g, by_game.get(int(g["id"]),[]))
+            self.warm=True
+        log.info("Game cache: %d open games loaded", len(self.games))
+
+    def game(self, gid: int) -> Optional[dict]:
+        """Live game dict (loaded on miss). Caller must hold the lock."""
+        g=self.games.get(gid)
+        if g is not None:
+            return g
+        self.flush()
+        with gdb(gid) as conn:
+            row=conn.execute("SELECT * FROM games WHERE id=?;",(gid,)).fetchone()
+            if not row:
+                return None
+            players=conn.execute("SELECT * FROM game_players WHERE game_id=? ORDER BY joined_at, id;",(gid,)).fetchall()
+        return self._put(row, players)
+
+    def game_players(self, gid: int) -> dict:
+        return self.players.get(gid, {}) if self.game(gid) is not None else {}
+
+    def write(self, sql: str, params: tuple, gid: Optional[int]=None):
+        """Queue a statement; gid routes it to that game's shard (None: DB_PATH)."""
+        self.pending.append((shard_of(gid), sql, params))
+        self.queued+=1
+        if len(self.pending)==GAME_FLUSH_OPS and self.on_full:
+            self.on_full()
+
+    def _committed(self, trigger: str, n: int):
+        self.durable=self.queued
+        self.forced.clear()
+        self.flushes+=1
+        self.flushed_stmts+=n
+        self.commits.append((time.monotonic(), n))
+        COMMIT_BATCH.observe(trigger, n)
+
+    def revalidate(self, gid: int):
+        """SHARED_DB: drop the cached copy of gid if another process has moved games.version on."""
+        g=self.games.get(gid)
+        if g is None:
+            return
+        with gdb(gid) as conn:
+            r=conn.execute("SELECT version FROM games WHERE id=?;",(gid,)).fetchone()
+        if r is None or int(r["version"])!=g["version"]:
+            self._evict(gid)
+            CAS_STATS["reloads"]+=1
+
+    def commit_cas(self, gid: int, base: int) -> bool:
+        """SHARED_DB: write the pending batch iff games.version is still `base`; False on conflict (batch dropped).
+        The game's rows commit atomically on its shard; user_stats bumps follow in DB_PATH once that succeeded."""
+        batch, self.pending = self.pending, []
+        key=shard_of(gid)
+        with gdb(gid) as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            if conn.execute("UPDATE games SET version=? WHERE id=? AND version=?;",(base+1,gid,base)).rowcount==0:
+                conn.rollback()
+                return False
+            for k, sql, params in batch:
+                if k==key: conn.execute(sql, params)
+        rest=[(sql, params) for k, sql, params in batch if k!=key]
+        if rest:
+            _write_batch(POOL, rest)
+        self._committed("cas", len(batch)+1)
+        return True
+
+    def flush(self, trigger: str="read"):
+        """Commit every queued write. trigger labels the batch in COMMIT_BATCH: read (a read
+        falling through to SQLite), or the GroupCommitWriter's timer/full/durable/shutdown."""
+        with self._lock:
+            if self.in_txn and SHARED_DB:
+                return
+            batch, self.pending = self.pending, []
+            if batch:
+                groups={}
+                for k, sql, params in batch:
+                    groups.setdefault(k,[]).append((sql, params))
+                errors=write_batches(groups)
+                if errors:
+                    # only the files that failed keep their statements (in order) for the next flush
+                    self.pending[:0]=[s for s in batch if s[0] in errors]
+                    raise next(iter(errors.values()))
+                self._committed(trigger, len(batch))
+            else:
+                self.durable=self.queued; self.forced.clear()
+            for gid in [gid for gid,g in self.games.items() if g["status"]=="ended"]:
+                self._evict(gid)
 
-def get_game_by_inline_id(inline_id: str) -> Optional[sqlite3.Row]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT * FROM games WHERE kind='inline' AND board_inline_id=? AND status!='ended' LIMIT 1;",(inline_id,))
-    r=cur.fetchone(); conn.close()
-    return r
+    def live_gids(self) -> set:
+        """Snapshot of the cached game ids, for sweeps that run on the event loop."""
+        with self._lock:
+            return set(self.games)
 
-def get_game(gid: int) -> Optional[sqlite3.Row]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT * FROM games WHERE id=?;",(gid,))
-    r=cur.fetchone(); conn.close()
-    return r
+    def stats(self) -> dict:
+        with self._lock:
+            return {"games":len(self.games),"pending":len(self.pending),
+                    "flushes":self.flushes,"flushed":self.flushed_stmts}
+
+CACHE = GameCache()
+
+# =========================
+# Question sampler (O(1) random pick)
+# =========================
+class QuestionSampler:
+    """Enabled question ids per (qtype, level), for constant-time random picks.
+
+    A bucket is loaded from SQLite on first use and then kept in sync by
+    add()/remove() (bulk insert, approved suggestion, disable) instead of being
+    re-queried. remove() swaps the id with the bucket's last one.
+    """
+    def __init__(self):
+        self._lock=threading.Lock()
+        self.ids={}  # (qtype, level) -> [qid]
+        self.pos={}  # (qtype, level) -> {qid: index in ids}
+
+    def _bucket(self, qtype: str, level: str) -> Tuple[list, dict]:
+        key=(qtype,level)
+        if key not in self.ids:
+            with db() as conn:
+                rows=conn.execute("SELECT id FROM questions WHERE enabled=1 AND qtype=? AND level=?;",(qtype,level)).fetchall()
+            ids=[int(r["id"]) for r in rows]
+            self.ids[key]=ids
+            self.pos[key]={qid:i for i,qid in enumerate(ids)}
+        return self.ids[key], self.pos[key]
+
+    def add(self, qtype: str, level: str, qids: List[int]):
+        with self._lock:
+            if (qtype,level) not in self.ids:
+                return  # not loaded yet: the first pick reads them from SQLite
+            ids, pos = self.ids[(qtype,level)], self.pos[(qtype,level)]
+            for qid in qids:
+                if qid not in pos:
+                    pos[qid]=len(ids); ids.append(qid)
+
+    def remove(self, qtype: str, level: str, qid: int):
+        with self._lock:
+            if (qtype,level) not in self.ids:
+                return
+            ids, pos = self.ids[(qtype,level)], self.pos[(qtype,level)]
+            i=pos.pop(qid, None)
+            if i is None:
+                return
+            last=ids.pop()
+            if last!=qid:
+                ids[i]=last; pos[last]=i
+
+    def has(self, qtype: str, level: str, qid: int) -> bool:
+        with self._lock:
+            return qid in self._bucket(qtype, level)[1]
+
+    def snapshot(self, qtype: str, level: str) -> array:
+        with self._lock:
+            return array("I", self._bucket(qtype, level)[0])
+
+    def pick(self, qtype: str, level: str) -> Optional[int]:
+        with self._lock:
+            ids,_=self._bucket(qtype, level)
+            return ids[random.randrange(len(ids))] if ids else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {f"{k[0]}/{k[1]}":len(v) for k,v in self.ids.items()}
+
+SAMPLER = QuestionSampler()
 
+# =========================
+# Game DB operations
+# =========================
+CAS_STATS = {"commits": 0, "conflicts": 0, "reloads": 0, "stale": 0}
+
+class GameConflict(Exception):
+    """A game transition kept losing its compare-and-swap to other processes."""
+
+def transition(gid: int, fn, *args, **kwargs):
+    """Run fn, a mutation of game gid, as one versioned state transition.
+
+    Nested calls join the outer transition. Every transition that wrote
+    something bumps games.version; alone in a process that is just an
+    in-memory counter, since the cache is authoritative. With SHARED_DB the cached game is first
+    revalidated against SQLite, then the transition's writes commit right away
+    as a compare-and-swap on the version read; if another process got there
+    first, our in-memory changes are dropped and fn runs again on a fresh copy.
+    """
+    with CACHE._lock:
+        if CACHE.in_txn:
+            return fn(*args, **kwargs)
+        for _ in range(max(1, CAS_RETRIES)):
+            if SHARED_DB:
+                CACHE.flush()
+                CACHE.revalidate(gid)
+            g=CACHE.game(gid)
+            base=g["version"] if g is not None else None
+            n=len(CACHE.pending)
+            CACHE.in_txn=True
+            try:
+                result=fn(*args, **kwargs)
+            except BaseException:
+                if SHARED_DB:
+                    del CACHE.pending[n:]
+                    CACHE._evict(gid)
+                raise
+            finally:
+                CACHE.in_txn=False
+            g=CACHE.games.get(gid)
+            if len(CACHE.pending)==n or g is None or base is None:
+                return result
+            if not SHARED_DB:
+                # the cache is authoritative and no one else reads SQLite's copy: no extra statement
+                g["version"]=base+1
+                return result
+            if CACHE.commit_cas(gid, base):
+                g["version"]=base+1
+                CAS_STATS["commits"]+=1
+                return result
+            CAS_STATS["conflicts"]+=1
+            CACHE._evict(gid)
+        raise GameConflict(f"game {gid}: no transition after {CAS_RETRIES} attempts")
+
+def versioned(fn):
+    """Make fn(gid, ...) a game state transition (see transition())."""
+    @functools.wraps(fn)
+    def wrapper(gid, *args, **kwargs):
+        return transition(int(gid), fn, gid, *args, **kwargs)
+    return wrapper
+
+def _create_game(**fields) -> int:
+    fields.update(status="lobby", created_at=now())
+    with CACHE._lock:
+        CACHE.flush()
+        if SHARDS:
+            # ids are unique across shards: allocate in DB_PATH, then insert into the shard it maps to
+            with db() as conn:
+                fields["id"]=int(conn.execute("INSERT INTO game_ids (created_at) VALUES (?);",(fields["created_at"],)).lastrowid)
+        with (gdb(fields["id"]) if SHARDS else db()) as conn:
+            gid=int(conn.execute(f"INSERT INTO games ({','.join(fields)}) VALUES ({','.join('?'*len(fields))});",
+                                 tuple(fields.values())).lastrowid)
+            row=conn.execute("SELECT * FROM games WHERE id=?;",(gid,)).fetchone()
+        CACHE._put(row, [])
+        return gid
+
+def create_group_game(chat_id: int, owner_id: int, board_message_id: int) -> int:
+    return _create_game(kind="group", owner_id=owner_id, board_chat_id=chat_id, board_message_id=board_message_id)
+
+def create_inline_game(owner_id: int, inline_id: str) -> int:
+    return _create_game(kind="inline", owner_id=owner_id, board_inline_id=inline_id)
+
+def get_group_game_by_chat(chat_id: int) -> Optional[dict]:
+    with CACHE._lock:
+        if CACHE.warm and not SHARED_DB:
+            gid=CACHE.by_chat.get(chat_id)
+            return get_game(gid) if gid else None
+        CACHE.flush()
+        gids=[]
+        for pool in game_pools():
+            with pool.connection() as conn:
+                r=conn.execute("""
+                  SELECT id FROM games WHERE kind='group' AND board_chat_id=? AND status!='ended'
+                  ORDER BY id DESC LIMIT 1;
+                """,(chat_id,)).fetchone()
+            if r: gids.append(int(r["id"]))
+        return get_game(max(gids)) if gids else None
+
+def get_game_by_inline_id(inline_id: str) -> Optional[dict]:
+    with CACHE._lock:
+        if CACHE.warm and not SHARED_DB:
+            gid=CACHE.by_inline.get(inline_id)
+            return get_game(gid) if gid else None
+        CACHE.flush()
+        for pool in game_pools():
+            with pool.connection() as conn:
+                r=conn.execute("SELECT id FROM games WHERE kind='inline' AND board_inline_id=? AND status!='ended' LIMIT 1;",(inline_id,)).fetchone()
+            if r: return get_game(int(r["id"]))
+        return None
+
+def get_game(gid: int) -> Optional[dict]:
+    with CACHE._lock:
+        if SHARED_DB and not CACHE.in_txn:
+            CACHE.revalidate(gid)
+        g=CACHE.game(gid)
+        return dict(g) if g is not None else None
+
+@versioned
 def set_game_fields(gid: int, **fields):
     if not fields: return
-    conn=db(); cur=conn.cursor()
     cols=[]; vals=[]
     for k,v in fields.items():
         cols.append(f"{k}=?"); vals.append(v)
     vals.append(gid)
-    cur.execute(f"UPDATE games SET {', '.join(cols)} WHERE id=?;", tuple(vals))
-    conn.commit(); conn.close()
-
+    with CACHE._lock:
+        g=CACHE.game(gid)
+        if g is not None:
+            g.update(fields)
+        CACHE.write(f"UPDATE games SET {', '.join(cols)} WHERE id=?;", tuple(vals), gid=gid)
+
+# Turn ring: games.turn_uid is the current player, and active players form a
+# doubly linked circle through prev_uid/next_uid. Current/next are O(1); a join
+# is linked in right before the current player (so it plays at the end of the
+# running round) and a leave unlinks without shifting anyone else's position.
+def _link(gid: int, p: dict, prev: Optional[int], nxt: Optional[int]):
+    p["prev_uid"]=prev; p["next_uid"]=nxt
+    CACHE.write("UPDATE game_players SET prev_uid=?, next_uid=? WHERE game_id=? AND user_id=?;",(prev,nxt,gid,p["user_id"]), gid=gid)
+
+def _ring_insert(gid: int, uid: int):
+    g=CACHE.game(gid); ps=CACHE.players[gid]
+    cur=g["turn_uid"]
+    if cur is None or cur not in ps:
+        _link(gid, ps[uid], uid, uid)
+        g["turn_uid"]=uid
+        CACHE.write("UPDATE games SET turn_uid=? WHERE id=?;",(uid,gid), gid=gid)
+        return
+    head=ps[cur]; tail=ps[head["prev_uid"]]
+    _link(gid, ps[uid], tail["user_id"], cur)
+    if tail is head:
+        _link(gid, head, uid, uid)
+    else:
+        _link(gid, tail, tail["prev_uid"], uid)
+        _link(gid, head, uid, head["next_uid"])
+
+def _ring_remove(gid: int, uid: int):
+    g=CACHE.game(gid); ps=CACHE.players[gid]
+    p=ps[uid]
+    prev, nxt = p["prev_uid"], p["next_uid"]
+    if nxt is None or nxt==uid:
+        new_turn=None
+    else:
+        new_turn=nxt
+        if prev==nxt:
+            _link(gid, ps[prev], prev, prev)
+        else:
+            _link(gid, ps[prev], ps[prev]["prev_uid"], nxt)
+            _link(gid, ps[nxt], prev, ps[nxt]["next_uid"])
+    _link(gid, p, None, None)
+    if g["turn_uid"]==uid:
+        g["turn_uid"]=new_turn
+        CACHE.write("UPDATE games SET turn_uid=? WHERE id=?;",(new_turn,gid), gid=gid)
+
+@versioned
 def upsert_player(gid: int, uid: int, name: str) -> bool:
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT id FROM game_players WHERE game_id=? AND user_id=?;",(gid,uid))
-    r=cur.fetchone()
-    if r:
-        cur.execute("UPDATE game_players SET active=1, name=? WHERE game_id=? AND user_id=?;",(name,gid,uid))
-        conn.commit(); conn.close()
-        return False
-    cur.execute("""
-      INSERT INTO game_players (game_id,user_id,name,joined_at,rerolls_left,active)
-      VALUES (?,?,?,?,?,1);
-    """,(gid,uid,name,now(),MAX_REROLL_PER_PLAYER))
-    conn.commit(); conn.close()
-    return True
+    with CACHE._lock:
+        ps=CACHE.game_players(gid)
+        p=ps.get(uid)
+        set_game_fields(gid, active_at=now())
+        if p:
+            was_active=p["active"]
+            p["active"]=1; p["name"]=name
+            CACHE.write("UPDATE game_players SET active=1, name=? WHERE game_id=? AND user_id=?;",(name,gid,uid), gid=gid)
+            if not was_active:
+                _ring_insert(gid, uid)
+            return False
+        joined=now()
+        ps[uid]={"id":None,"game_id":gid,"user_id":uid,"name":name,"joined_at":joined,
+                 "rerolls_left":MAX_REROLL_PER_PLAYER,"skips_used":0,"penalties":0,"turns":0,"active":1,
+                 "prev_uid":None,"next_uid":None}
+        CACHE.write("""
+          INSERT INTO game_players (game_id,user_id,name,joined_at,rerolls_left,active)
+          VALUES (?,?,?,?,?,1);
+        """,(gid,uid,name,joined,MAX_REROLL_PER_PLAYER), gid=gid)
+        _ring_insert(gid, uid)
+        return True
+
+@versioned
+def remove_player(gid: int, uid: int) -> Tuple[bool, Optional[dict]]:
+    """Deactivate a player (leave/kick) and unlink them from the turn ring.
+    Returns (removed, new current player if a running game's turn passed on)."""
+    with CACHE._lock:
+        p=CACHE.game_players(gid).get(uid)
+        if not p or not p["active"]:
+            return False, None
+        g=CACHE.games[gid]
+        had_turn=g["turn_uid"]==uid
+        _ring_remove(gid, uid)
+        p["active"]=0
+        CACHE.write("UPDATE game_players SET active=0 WHERE game_id=? AND user_id=?;",(gid,uid), gid=gid)
+        if not (had_turn and g["status"]=="running" and g["turn_uid"] is not None):
+            return True, None
+        set_game_fields(gid, phase="choose", view="main")
+        inc_stat(gid, g["turn_uid"], "turns", 1)
+        return True, player_row(gid, g["turn_uid"])
 
-def list_players(gid: int) -> List[sqlite3.Row]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT * FROM game_players WHERE game_id=? AND active=1 ORDER BY joined_at ASC;",(gid,))
-    rows=cur.fetchall(); conn.close()
-    return rows
+def list_players(gid: int) -> List[dict]:
+    # join order == joined_at order: players are loaded sorted and appended on join
+    with CACHE._lock:
+        return [dict(p) for p in CACHE.game_players(gid).values() if p["active"]]
 
-def player_row(gid: int, uid: int) -> Optional[sqlite3.Row]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT * FROM game_players WHERE game_id=? AND user_id=? AND active=1;",(gid,uid))
-    r=cur.fetchone(); conn.close()
-    return r
+def player_row(gid: int, uid: int) -> Optional[dict]:
+    with CACHE._lock:
+        p=CACHE.game_players(gid).get(uid)
+        return dict(p) if p and p["active"] else None
 
 def rerolls_left(gid: int, uid: int) -> int:
     r=player_row(gid,uid)
     return int(r["rerolls_left"]) if r else 0
 
+@versioned
 def dec_reroll(gid: int, uid: int) -> bool:
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT rerolls_left FROM game_players WHERE game_id=? AND user_id=?;",(gid,uid))
-    r=cur.fetchone()
-    if not r: conn.close(); return False
-    left=int(r["rerolls_left"])
-    if left<=0: conn.close(); return False
-    cur.execute("UPDATE game_players SET rerolls_left=rerolls_left-1 WHERE game_id=? AND user_id=?;",(gid,uid))
-    conn.commit(); conn.close()
-    return True
-
+    with CACHE._lock:
+        p=CACHE.game_players(gid).get(uid)
+        if not p or p["rerolls_left"]<=0:
+            return False
+        p["rerolls_left"]-=1
+        CACHE.write("UPDATE game_players SET rerolls_left=rerolls_left-1 WHERE game_id=? AND user_id=?;",(gid,uid), gid=gid)
+        return True
+
+USER_STAT_FIELDS = {"turns":"turns", "penalties":"penalties", "skips_used":"skips", "refused":"refusals", "confirmed":"confirmations"}
+# chat_id -> version, bumped on every stats change so cached leaderboard pages go stale. Only chats
+# with pages in TOP_CACHE have an entry, and both are cleared together, so it is as bounded as the cache.
+TOP_VERSIONS = {}
+
+def _bump_user_stats(gid: int, uid: int, field: str, delta: int=1):
+    """Queue a lifetime-stats upsert next to the game write that caused it. Caller must hold the lock."""
+    g=CACHE.games.get(gid)
+    p=CACHE.players.get(gid, {}).get(uid)
+    if g is None or p is None:
+        return
+    chat=int(g["board_chat_id"]) if g["kind"]=="group" else 0
+    d={f: 0 for f in ("turns","penalties","skips","refusals","confirmations")}
+    d[USER_STAT_FIELDS[field]]=delta
+    CACHE.write("""
+      INSERT INTO user_stats (chat_id,user_id,name,turns,penalties,skips,refusals,confirmations,updated_at)
+      VALUES (?,?,?,?,?,?,?,?,?)
+      ON CONFLICT(chat_id,user_id) DO UPDATE SET
+        name=excluded.name, turns=turns+excluded.turns, penalties=penalties+excluded.penalties,
+        skips=skips+excluded.skips, refusals=refusals+excluded.refusals,
+        confirmations=confirmations+excluded.confirmations, updated_at=excluded.updated_at;
+    """,(chat,uid,p["name"],d["turns"],d["penalties"],d["skips"],d["refusals"],d["confirmations"],now()))
+    if chat in TOP_VERSIONS:
+        TOP_VERSIONS[chat]+=1
+
+@versioned
 def inc_stat(gid: int, uid: int, field: str, delta: int=1):
     if field not in ("turns","penalties","skips_used"): return
-    conn=db(); cur=conn.cursor()
-    cur.execute(f"UPDATE game_players SET {field}={field}+? WHERE game_id=? AND user_id=?;",(delta,gid,uid))
-    conn.commit(); conn.close()
-
-def current_player(g: sqlite3.Row) -> Optional[sqlite3.Row]:
-    players=list_players(int(g["id"]))
-    if not players: return None
-    idx=int(g["current_turn_index"])%len(players)
-    return players[idx]
-
+    with CACHE._lock:
+        p=CACHE.game_players(gid).get(uid)
+        if p:
+            p[field]+=delta
+        CACHE.write(f"UPDATE game_players SET {field}={field}+? WHERE game_id=? AND user_id=?;",(delta,gid,uid), gid=gid)
+        _bump_user_stats(gid, uid, field, delta)
+
+def current_player(g: sqlite3.Row) -> Optional[dict]:
+    uid=g["turn_uid"]
+    return player_row(int(g["id"]), int(uid)) if uid is not None else None
+
+@versioned
 def advance_turn(gid: int):
-    conn=db(); cur=conn.cursor()
-    cur.execute("UPDATE games SET current_turn_index=current_turn_index+1, phase='choose' WHERE id=?;",(gid,))
-    conn.commit(); conn.close()
+    with CACHE._lock:
+        g=CACHE.game(gid)
+        if g is None:
+            return
+        cur=CACHE.players[gid].get(g["turn_uid"])
+        nxt=cur["next_uid"] if cur else None
+        g["current_turn_index"]+=1; g["phase"]="choose"; g["turn_uid"]=nxt
+        CACHE.write("UPDATE games SET current_turn_index=current_turn_index+1, turn_uid=?, phase='choose' WHERE id=?;",(nxt,gid), gid=gid)
+
+def question_text(qid: int) -> Optional[str]:
+    with db() as conn:
+        r=conn.execute("SELECT text FROM questions WHERE id=? AND enabled=1;",(qid,)).fetchone()
+    return r["text"] if r else None
 
 def pick_random_question(qtype: str, level: str) -> Optional[str]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("""
-      SELECT text FROM questions
-      WHERE enabled=1 AND qtype=? AND level=?
-      ORDER BY RANDOM() LIMIT 1;
-    """,(qtype,level))
-    r=cur.fetchone(); conn.close()
-    return r["text"] if r else None
+    for _ in range(3):
+        qid=SAMPLER.pick(qtype, level)
+        if qid is None:
+            return None
+        text=question_text(qid)
+        if text is not None:
+            return text
+        SAMPLER.remove(qtype, level, qid)  # disabled/deleted behind the sampler's back
+    return None
+
+class Deck:
+    """Shuffle bag of question ids for one (game, qtype, level), packed as uint32."""
+    __slots__=("ids","pos")
+    def __init__(self, ids: array, pos: int=0):
+        self.ids=ids
+        self.pos=pos
+
+def _game_deck(gid: int, qtype: str, level: str) -> Optional[Deck]:
+    decks=CACHE.decks.setdefault(gid, {})
+    d=decks.get((qtype,level))
+    if d is None:
+        # every queued deck write also lands in CACHE.decks (dropped only with its pending
+        # writes, or after they were flushed), so a miss has nothing pending and reads SQLite
+        with gdb(gid) as conn:
+            r=conn.execute("SELECT deck,pos FROM game_decks WHERE game_id=? AND qtype=? AND level=?;",(gid,qtype,level)).fetchone()
+        if r:
+            ids=array("I"); ids.frombytes(r["deck"])
+            d=decks[(qtype,level)]=Deck(ids, int(r["pos"]))
+    return d
+
+def _reshuffle(gid: int, qtype: str, level: str, last: Optional[int]) -> Deck:
+    ids=SAMPLER.snapshot(qtype, level)
+    random.shuffle(ids)
+    if last is not None and len(ids)>1 and ids[0]==last:
+        ids[0], ids[-1] = ids[-1], ids[0]  # no back-to-back repeat across decks
+    d=CACHE.decks.setdefault(gid, {})[(qtype,level)]=Deck(ids)
+    CACHE.write("INSERT OR REPLACE INTO game_decks (game_id,qtype,level,deck,pos) VALUES (?,?,?,?,0);",
+                (gid,qtype,level,ids.tobytes()), gid=gid)
+    return d
+
+@versioned
+def draw_question(gid: int, qtype: str, level: str) -> Optional[str]:
+    """Next question of this game's deck; no repeats until every question was drawn."""
+    with CACHE._lock:
+        if CACHE.game(gid) is None:
+            return pick_random_question(qtype, level)
+        d=_game_deck(gid, qtype, level)
+        last=None
+        for _ in range(3):
+            if d is None or d.pos>=len(d.ids):
+                d=_reshuffle(gid, qtype, level, last)
+                if not d.ids:
+                    return None
+            # skip ids disabled since the deck was shuffled
+            while d.pos<len(d.ids):
+                qid=d.ids[d.pos]; d.pos+=1; last=qid
+                if SAMPLER.has(qtype, level, qid):
+                    break
+            else:
+                continue
+            CACHE.write("UPDATE game_decks SET pos=? WHERE game_id=? AND qtype=? AND level=?;",(d.pos,gid,qtype,level), gid=gid)
+            text=question_text(qid)
+            if text is not None:
+                return text
+            SAMPLER.remove(qtype, level, qid)
+        return None
 
 def queue_forced(gid: int, uid: int, text: str, qtype: Optional[str], level: Optional[str]):
-    conn=db(); cur=conn.cursor()
-    cur.execute("""
-      INSERT INTO forced_questions (game_id,user_id,qtype,level,text,created_at)
-      VALUES (?,?,?,?,?,?);
-    """,(gid,uid,qtype,level,text,now()))
-    conn.commit(); conn.close()
+    """Queued with the game's writes (await WRITER.durable() to know it is on disk)."""
+    with CACHE._lock:
+        CACHE.forced.add(gid)
+        CACHE.write("""
+          INSERT INTO forced_questions (game_id,user_id,qtype,level,text,created_at)
+          VALUES (?,?,?,?,?,?);
+        """,(gid,uid,qtype,level,text,now()), gid=gid)
 
 def pop_forced(gid: int, uid: int, qtype: str, level: str) -> Optional[str]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("""
-      SELECT id,text FROM forced_questions
-      WHERE game_id=? AND user_id=?
-        AND (qtype IS NULL OR qtype=?)
-        AND (level IS NULL OR level=?)
-      ORDER BY id ASC LIMIT 1;
-    """,(gid,uid,qtype,level))
-    r=cur.fetchone()
-    if not r: conn.close(); return None
-    fid=int(r["id"]); txt=r["text"]
-    cur.execute("DELETE FROM forced_questions WHERE id=?;",(fid,))
-    conn.commit(); conn.close()
-    return txt
-
+    with CACHE._lock:
+        if gid in CACHE.forced:
+            CACHE.flush()
+    with gdb(gid) as conn:
+        while True:
+            r=conn.execute("""
+              SELECT id FROM forced_questions
+              WHERE game_id=? AND user_id=?
+                AND (qtype IS NULL OR qtype=?)
+                AND (level IS NULL OR level=?)
+              ORDER BY id ASC LIMIT 1;
+            """,(gid,uid,qtype,level)).fetchone()
+            if not r: return None
+            # claim it: if another process sharing the DB deleted it first, look again
+            r=conn.execute("DELETE FROM forced_questions WHERE id=? RETURNING text;",(int(r["id"]),)).fetchone()
+            if r: return r["text"]
+
+# Actions are write-behind too: the cache keeps each open game's latest action,
+# and status updates target "the game's newest row" so they need no row id.
+@versioned
 def create_action(gid: int, actor_id: int, qtype: str, level: str, text: str, status: str):
-    conn=db(); cur=conn.cursor()
-    cur.execute("""
-      INSERT INTO actions (game_id,actor_id,qtype,level,text,status,created_at)
-      VALUES (?,?,?,?,?,?,?);
-    """,(gid,actor_id,qtype,level,text,status,now()))
-    aid=int(cur.lastrowid)
-    conn.commit(); conn.close()
-    return aid
-
-def last_action(gid: int) -> Optional[sqlite3.Row]:
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT * FROM actions WHERE game_id=? ORDER BY id DESC LIMIT 1;",(gid,))
-    r=cur.fetchone(); conn.close()
+    ts=now()
+    with CACHE._lock:
+        if gid in CACHE.games:
+            CACHE.last_actions[gid]={"id":None,"game_id":gid,"actor_id":actor_id,"qtype":qtype,"level":level,
+                                     "text":text,"status":status,"created_at":ts}
+        CACHE.write("""
+          INSERT INTO actions (game_id,actor_id,qtype,level,text,status,created_at)
+          VALUES (?,?,?,?,?,?,?);
+        """,(gid,actor_id,qtype,level,text,status,ts), gid=gid)
+        if status in ("refused","confirmed"):
+            _bump_user_stats(gid, actor_id, status)
+
+@versioned
+def set_last_action_status(gid: int, status: str):
+    with CACHE._lock:
+        la=_last_action_live(gid)
+        if la:
+            if status=="confirmed" and la["status"]!="confirmed":
+                _bump_user_stats(gid, int(la["actor_id"]), status)
+            la["status"]=status
+        CACHE.write("UPDATE actions SET status=? WHERE id=(SELECT MAX(id) FROM actions WHERE game_id=?);",(status,gid), gid=gid)
+
+def _last_action_live(gid: int) -> Optional[dict]:
+    """Cached last action dict (not a copy). Caller must hold the lock."""
+    if gid in CACHE.last_actions:
+        return CACHE.last_actions[gid]
+    # every queued action of a cached game is also in last_actions, so a
+    # miss has nothing pending for this game and can read SQLite directly
+    with gdb(gid) as conn:
+        r=conn.execute("SELECT * FROM actions WHERE game_id=? ORDER BY id DESC LIMIT 1;",(gid,)).fetchone()
+    la=dict(r) if r else None
+    if gid in CACHE.games:
+        CACHE.last_actions[gid]=la
+    return la
+
+def last_action(gid: int) -> Optional[dict]:
+    with CACHE._lock:
+        la=_last_action_live(gid)
+        return dict(la) if la else None
+
+@versioned
+def start_game(gid: int) -> Tuple[Optional[dict], Optional[dict]]:
+    """lobby -> running in one step; returns (game, first player). No-op (player None) unless still in the lobby."""
+    with CACHE._lock:
+        g=CACHE.game(gid)
+        if g is None or g["status"]!="lobby":
+            CAS_STATS["stale"]+=1
+            return get_game(gid), None
+        set_game_fields(gid, status="running", view="main", phase="choose", active_at=now())
+        g=get_game(gid)
+        cp=current_player(g) if g else None
+        if cp:
+            inc_stat(gid, int(cp["user_id"]), "turns", 1)
+            cp=player_row(gid, int(cp["user_id"]))
+        return g, cp
+
+def _on_turn(gid: int, actor_id: int, phase: Optional[str]=None) -> bool:
+    """Is game gid running with actor_id to play (and in `phase`, if given)? Counts a stale click if not."""
+    g=CACHE.game(gid)
+    if g is None or g["status"]!="running" or g["turn_uid"]!=actor_id or (phase and g["phase"]!=phase):
+        CAS_STATS["stale"]+=1
+        return False
+    return True
+
+@versioned
+def turn_transition(gid: int, actor_id: int, stat: Optional[str]=None, reroll_loss: float=0.0,
+                    last_status: Optional[str]=None, action: Optional[Tuple[str,str,str,str]]=None,
+                    phase: Optional[str]=None) -> Tuple[Optional[dict], Optional[dict]]:
+    """End actor_id's turn and hand it to the next player, as one atomic change.
+
+    In order: actor's `stat` +1, lose a reroll with probability `reroll_loss`,
+    set the last action's status, add `action` (qtype, level, text, status),
+    advance the turn, reset phase/view and count the new player's turn. All of
+    it is applied under the cache lock, so no handler sees a half-done turn, and
+    reaches SQLite in a single flush transaction. Returns (game, current player).
+
+    Nothing happens, and (None, None) comes back, unless the game is running
+    with actor_id to play (and in `phase`, if given): a repeated click or a
+    timeout that lost the race must not move the turn a second time.
+    """
+    with CACHE._lock:
+        if not _on_turn(gid, actor_id, phase):
+            return None, None
+        last_action(gid)  # warm before queuing anything
+        if stat:
+            inc_stat(gid, actor_id, stat, 1)
+        if reroll_loss and random.random()<reroll_loss:
+            dec_reroll(gid, actor_id)
+        if last_status:
+            set_last_action_status(gid, last_status)
+        if action:
+            create_action(gid, actor_id, *action)
+        advance_turn(gid)
+        if action and action[0]=="timeout":
+            set_game_fields(gid, phase="choose", view="main")
+        else:
+            set_game_fields(gid, phase="choose", view="main", active_at=now())
+        g=get_game(gid)
+        cp=current_player(g)
+        if cp:
+            inc_stat(gid, int(cp["user_id"]), "turns", 1)
+            cp=player_row(gid, int(cp["user_id"]))
+        return g, cp
+
+# Moves inside a turn. Like turn_transition, each one rechecks the turn and
+# phase under the lock and returns None, writing nothing, if the click is stale.
+@versioned
+def ask_question(gid: int, actor_id: int, qtype: str, level: str, text: str) -> Optional[dict]:
+    """choose -> question: put `text` to actor_id and record it as asked."""
+    with CACHE._lock:
+        if not _on_turn(gid, actor_id, "choose"):
+            return None
+        set_game_fields(gid, phase="question", last_q_text=text, last_q_by=actor_id,
+                        last_qtype=qtype, last_level=level, view="main", active_at=now())
+        create_action(gid, actor_id, qtype, level, text, "asked")
+        return get_game(gid)
+
+@versioned
+def await_confirm(gid: int, actor_id: int) -> Optional[dict]:
+    """question -> wait_confirm: actor_id says it's done, the other player has to confirm."""
+    with CACHE._lock:
+        if not _on_turn(gid, actor_id, "question"):
+            return None
+        set_game_fields(gid, phase="wait_confirm", view="main", active_at=now())
+        set_last_action_status(gid, "done_wait")
+        return get_game(gid)
+
+@versioned
+def use_reroll(gid: int, actor_id: int) -> Optional[dict]:
+    """Spend one of actor_id's rerolls while choosing. None also when none are left."""
+    with CACHE._lock:
+        if not _on_turn(gid, actor_id, "choose") or not dec_reroll(gid, actor_id):
+            return None
+        set_game_fields(gid, active_at=now())
+        return get_game(gid)
+
+def add_questions(qtype: str, level: str, texts: List[str]) -> int:
+    ts=now()
+    with db() as conn:
+        qids=[int(conn.execute(
+            "INSERT INTO questions (qtype,level,text,enabled,created_at) VALUES (?,?,?,?,?);",
+            (qtype,level,t,1,ts)).lastrowid) for t in texts]
+    SAMPLER.add(qtype, level, qids)
+    return len(qids)
+
+def set_question_enabled(qid: int, enabled: bool) -> Optional[sqlite3.Row]:
+    with db() as conn:
+        r=conn.execute("SELECT qtype,level FROM questions WHERE id=?;",(qid,)).fetchone()
+        if not r: return None
+        conn.execute("UPDATE questions SET enabled=? WHERE id=?;",(1 if enabled else 0, qid))
+    if enabled:
+        SAMPLER.add(r["qtype"], r["level"], [qid])
+    else:
+        SAMPLER.remove(r["qtype"], r["level"], qid)
     return r
 
+def pending_suggestions(limit: int=10) -> List[sqlite3.Row]:
+    with db() as conn:
+        return conn.execute("SELECT * FROM suggestions WHERE status='pending' ORDER BY id ASC LIMIT ?;",(limit,)).fetchall()
+
+def review_suggestion(sid: int, approve: bool) -> bool:
+    with db() as conn:
+        cur=conn.cursor()
+        cur.execute("SELECT * FROM suggestions WHERE id=?;",(sid,))
+        s=cur.fetchone()
+        if not s: return False
+        if not approve:
+            cur.execute("UPDATE suggestions SET status='rejected', reviewed_by=?, reviewed_at=? WHERE id=?;",(ADMIN_ID,now(),sid))
+            return True
+        cur.execute("UPDATE suggestions SET status='approved', reviewed_by=?, reviewed_at=? WHERE id=?;",(ADMIN_ID,now(),sid))
+        cur.execute("INSERT INTO questions (qtype,level,text,enabled,created_at) VALUES (?,?,?,?,?);",(s["qtype"],s["level"],s["text"],1,now()))
+        qid=int(cur.lastrowid)
+    SAMPLER.add(s["qtype"], s["level"], [qid])
+    return True
+
+def running_games(limit: int=10) -> List[dict]:
+    with CACHE._lock:
+        if CACHE.warm and not SHARED_DB:
+            gids=sorted((gid for gid,g in CACHE.games.items() if g["status"]=="running"), reverse=True)[:limit]
+            return [{"id":gid,"kind":CACHE.games[gid]["kind"],"status":"running"} for gid in gids]
+        CACHE.flush()
+        rows=[]
+        for pool in game_pools():
+            with pool.connection() as conn:
+                rows+=conn.execute("SELECT id,kind,status FROM games WHERE status='running' ORDER BY id DESC LIMIT ?;",(limit,)).fetchall()
+        return sorted(rows, key=lambda r: r["id"], reverse=True)[:limit]
+
+TOP_CACHE = {}   # (chat_id, cursor, back) -> (version, rows, more)
+
+def top_page(chat_id: int, cursor: Optional[Tuple[int,int,int]]=None, back: bool=False) -> Tuple[List[dict], bool]:
+    """One leaderboard page, ranked via idx_user_stats_rank and paged by keyset on the rank key
+    (confirmations, turns, user_id): the rows right after `cursor` (a page's last row), or with
+    back=True right before it (a page's first row), so deep pages skip nothing by OFFSET.
+    The bool says whether more rows lie beyond the page in that direction. Pages are cached
+    until the chat's stats change; not with SHARED_DB, where peers' writes would not invalidate them."""
+    key=(chat_id, cursor, back)
+    with CACHE._lock:
+        ver=TOP_VERSIONS.get(chat_id,0)
+        hit=None if SHARED_DB else TOP_CACHE.get(key)
+        if hit and hit[0]==ver:
+            return hit[1], hit[2]
+        CACHE.flush()
+        cols="user_id,name,turns,penalties,skips,refusals,confirmations"
+        with db() as conn:
+            if cursor is None:
+                rows=conn.execute(f"""
+                  SELECT {cols} FROM user_stats WHERE chat_id=?
+                  ORDER BY confirmations DESC, turns DESC, user_id LIMIT ?;
+                """,(chat_id, TOP_PAGE_SIZE+1)).fetchall()
+            elif not back:
+                c,t,u=cursor
+                rows=conn.execute(f"""
+                  SELECT {cols} FROM user_stats
+                  WHERE chat_id=? AND confirmations<=? AND (confirmations<? OR turns<? OR (turns=? AND user_id>?))
+                  ORDER BY confirmations DESC, turns DESC, user_id LIMIT ?;
+                """,(chat_id, c, c, t, t, u, TOP_PAGE_SIZE+1)).fetchall()
+            else:
+                c,t,u=cursor
+                rows=conn.execute(f"""
+                  SELECT {cols} FROM user_stats
+                  WHERE chat_id=? AND confirmations>=? AND (confirmations>? OR turns>? OR (turns=? AND user_id<?))
+                  ORDER BY confirmations, turns, user_id DESC LIMIT ?;
+                """,(chat_id, c, c, t, t, u, TOP_PAGE_SIZE+1)).fetchall()
+        rows=[dict(r) for r in rows]
+        more=len(rows)>TOP_PAGE_SIZE
+        rows=rows[:TOP_PAGE_SIZE]
+        if back:
+            rows.reverse()
+        if not SHARED_DB:
+            if len(TOP_CACHE)>=4096:
+                TOP_CACHE.clear(); TOP_VERSIONS.clear()
+            TOP_CACHE[key]=(TOP_VERSIONS.setdefault(chat_id, ver), rows, more)
+        return rows, more
+
+# =========================
+# Retention (آرشیو بازی‌های تمام شده + فشرده‌سازی دیتابیس)
+# =========================
+RETENTION_STATS = {"runs": 0, "idle_ended": 0, "archived": 0, "purged_rows": 0, "forced_purged": 0, "vacuumed_pages": 0, "analyzed_at": 0.0}
+
+def _archive_summary(conn: sqlite3.Connection, g: sqlite3.Row) -> bytes:
+    gid=int(g["id"])
+    players=conn.execute("""
+      SELECT user_id,name,turns,penalties,skips_used,rerolls_left FROM game_players
+      WHERE game_id=? ORDER BY joined_at, id;
+    """,(gid,)).fetchall()
+    by_status=dict(conn.execute("SELECT status, COUNT(*) FROM actions WHERE game_id=? GROUP BY status;",(gid,)).fetchall())
+    by_qtype=dict(conn.execute("SELECT qtype, COUNT(*) FROM actions WHERE game_id=? GROUP BY qtype;",(gid,)).fetchall())
+    summary={
+        "turns": g["current_turn_index"],
+        "players": [list(p) for p in players],
+        "actions": {"total": sum(by_status.values()), "by_status": by_status, "by_qtype": by_qtype},
+        "last_q": g["last_q_text"] or "",
+    }
+    return zlib.compress(json.dumps(summary, ensure_ascii=False, separators=(",",":")).encode(), 9)
+
+@versioned
+def end_idle_game(gid: int, cutoff: int) -> bool:
+    """End open game gid unless a player has been active in it since `cutoff`."""
+    with CACHE._lock:
+        g=CACHE.game(gid)
+        if g is None or g["status"]=="ended" or (g["active_at"] or g["created_at"])>=cutoff:
+            return False
+        set_game_fields(gid, status="ended", ended_at=now(), view="main")
+        return True
+
+def end_idle_games(limit: int=RETENTION_BATCH) -> int:
+    """End up to `limit` lobby/running games idle for GAME_IDLE_TTL_SEC; the flush evicts them from the cache."""
+    if GAME_IDLE_TTL_SEC<=0:
+        return 0
+    cutoff=now()-GAME_IDLE_TTL_SEC
+    gids=[]
+    with CACHE._lock:
+        CACHE.flush()
+        for pool in game_pools():
+            with pool.connection() as conn:
+                gids+=[int(r["id"]) for r in conn.execute("""
+                  SELECT id FROM games WHERE status IN ('lobby','running') AND COALESCE(active_at, created_at)<?
+                  ORDER BY id LIMIT ?;
+                """,(cutoff,limit))]
+        ended=sum(end_idle_game(gid, cutoff) for gid in gids[:limit])
+        CACHE.flush()
+    RETENTION_STATS["idle_ended"]+=ended
+    return ended
+
+def archive_ended_games(limit: int=RETENTION_BATCH) -> int:
+    """Roll up to `limit` games ended before ARCHIVE_AFTER_SEC into games_archive, one transaction per file."""
+    cutoff=now()-ARCHIVE_AFTER_SEC
+    archived=purged=0
+    with CACHE._lock:
+        CACHE.flush()
+        for pool in game_pools():
+            if archived>=limit:
+                break
+            with pool.connection() as conn:
+                games=conn.execute("""
+                  SELECT * FROM games WHERE status='ended' AND ended_at<? ORDER BY id LIMIT ?;
+                """,(cutoff,limit-archived)).fetchall()
+                games=[g for g in games if int(g["id"]) not in CACHE.games]
+                purged+=_archive_games(conn, games)
+            archived+=len(games)
+    RETENTION_STATS["archived"]+=archived
+    RETENTION_STATS["purged_rows"]+=purged
+    return archived
+
+def _archive_games(conn: sqlite3.Connection, games: List[sqlite3.Row]) -> int:
+    """Archive `games` and delete their rows; returns how many rows were purged."""
+    purged=0
+    for g in games:
+        gid=int(g["id"])
+        conn.execute("""
+          INSERT OR REPLACE INTO games_archive (game_id,kind,owner_id,board_chat_id,created_at,ended_at,summary)
+          VALUES (?,?,?,?,?,?,?);
+        """,(gid,g["kind"],g["owner_id"],g["board_chat_id"],g["created_at"],g["ended_at"],_archive_summary(conn, g)))
+        for table in ("actions","game_players","forced_questions","game_decks"):
+            purged+=conn.execute(f"DELETE FROM {table} WHERE game_id=?;",(gid,)).rowcount
+        conn.execute("DELETE FROM games WHERE id=?;",(gid,))
+    return purged
+
+def compact_db():
+    """Drop stale forced questions, return free pages to the OS, re-ANALYZE once per ANALYZE_EVERY_SEC (every file)."""
+    analyze=time.time()-RETENTION_STATS["analyzed_at"]>=ANALYZE_EVERY_SEC
+    for pool in [POOL]+SHARDS:
+        with pool.connection() as conn:
+            n=conn.execute("DELETE FROM forced_questions WHERE created_at<?;",(now()-FORCED_TTL_SEC,)).rowcount
+            conn.commit()
+            free=int(conn.execute("PRAGMA freelist_count;").fetchone()[0])
+            pages=free if VACUUM_PAGES<=0 else min(free, VACUUM_PAGES)
+            if pages:
+                # executescript steps the pragma to completion; execute() frees a single page
+                conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+            if analyze:
+                conn.execute("ANALYZE;")
+        RETENTION_STATS["forced_purged"]+=n
+        RETENTION_STATS["vacuumed_pages"]+=pages
+    if analyze:
+        RETENTION_STATS["analyzed_at"]=time.time()
+    RETENTION_STATS["runs"]+=1
+
 # =========================
 # LOCKS (برای حذف لگ/هنگ ادیت)
 # =========================
+class GameRuntime:
+    """In-memory state of one live board: edit lock, pending edit, last sent fingerprint."""
+    __slots__=("lock","edit","fingerprint","used")
+    def __init__(self):
+        self.lock=asyncio.Lock()
+        self.edit=None          # BoardEditState while an edit is pending
+        self.fingerprint=None   # digest of the last render that reached Telegram
+        self.used=time.monotonic()
+
+    def busy(self) -> bool:
+        return self.lock.locked() or self.edit is not None
+
+class GameRuntimes:
+    """Registry of GameRuntime by gid. An entry is freed once its game has left
+    the game cache (ended) or has been idle for RUNTIME_IDLE_TTL_SEC, never while busy."""
+    def __init__(self):
+        self.games={}
+        self.stats={"created":0,"freed_ended":0,"freed_idle":0}
+
+    def get(self, gid: int) -> GameRuntime:
+        rt=self.games.get(gid)
+        if rt is None:
+            rt=self.games[gid]=GameRuntime()
+            self.stats["created"]+=1
+        rt.used=time.monotonic()
+        return rt
+
+    def sweep(self, live: set, since: float):
+        """live: CACHE.live_gids() taken at `since`; entries used after that are left for the next sweep."""
+        t=time.monotonic()
+        for gid, rt in list(self.games.items()):
+            if rt.busy() or rt.used>=since:
+                continue
+            if gid not in live:
+                del self.games[gid]; self.stats["freed_ended"]+=1
+            elif t-rt.used>RUNTIME_IDLE_TTL_SEC:
+                del self.games[gid]; self.stats["freed_idle"]+=1
+
+RUNTIME = GameRuntimes()
+
 def game_lock(app: Application, gid: int) -> asyncio.Lock:
-    locks = app.bot_data.setdefault("game_locks", {})
-    if gid not in locks:
-        locks[gid] = asyncio.Lock()
-    return locks[gid]
+    return RUNTIME.get(gid).lock
 
 # =========================
 # UI Builders
 # =========================
-def kb_main(g: sqlite3.Row, uid: int) -> InlineKeyboardMarkup:
-    gid=int(g["id"])
-    players=list_players(gid)
-    phase=g["phase"]
-    allow18=int(g["allow_18"])==1
+class GameRec:
+    """Board-relevant columns of a game, copied once per render (g["x"] still works)."""
+    __slots__=("id","kind","status","phase","view","allow_18","allow_mid_join","show_prev_question",
+               "last_q_text","turn_uid","board_chat_id","board_message_id","board_inline_id")
+    def __init__(self, g: dict):
+        for k in GameRec.__slots__:
+            setattr(self, k, g[k])
+    def __getitem__(self, k: str):
+        return getattr(self, k)
+
+class PlayerRec:
+    __slots__=("user_id","name","rerolls_left","turns","penalties","skips_used")
+    def __init__(self, p: dict):
+        for k in PlayerRec.__slots__:
+            setattr(self, k, p[k])
+
+class BoardSnapshot:
+    """Everything one render needs: game, active players (join order), whose turn, viewer, last action."""
+    __slots__=("game","players","current","viewer","last")
+    def __init__(self, game, players, current, viewer, last):
+        self.game=game; self.players=players; self.current=current; self.viewer=viewer; self.last=last
+
+def load_snapshot(gid: int, uid: int) -> Optional[BoardSnapshot]:
+    """One pass over the cached game under one lock hold; render_text/kb_main never query."""
+    with CACHE._lock:
+        g=CACHE.game(gid)
+        if g is None:
+            return None
+        turn_uid=g["turn_uid"]
+        ps=[]; cur=me=None
+        for p in CACHE.players.get(gid, {}).values():
+            if not p["active"]:
+                continue
+            r=PlayerRec(p)
+            ps.append(r)
+            if r.user_id==turn_uid: cur=r
+            if r.user_id==uid: me=r
+        la=None
+        if g["status"]=="running" and g["phase"] in ("question","wait_confirm"):
+            la=_last_action_live(gid)
+            la=(la["qtype"], la["level"], la["text"]) if la else None
+        return BoardSnapshot(GameRec(g), ps, cur, me, la)
+
+def kb_main(s: BoardSnapshot) -> InlineKeyboardMarkup:
+    g=s.game
+    gid=g.id
+    phase=g.phase
+    allow18=int(g.allow_18)==1
 
     rows=[]
-    join_label = f"✋ منم میخوام بازی کنم ({len(players)})"
+    join_label = f"✋ منم میخوام بازی کنم ({len(s.players)})"
     rows.append([
         InlineKeyboardButton(join_label, callback_data=f"g{gid}:join"),
         InlineKeyboardButton("⚙️ تنظیمات", callback_data=f"g{gid}:view:settings"),
     ])
 
     # Start only useful in lobby; show for all, but only owner can execute (toast)
-    if g["status"]=="lobby":
+    if g.status=="lobby":
         rows.append([InlineKeyboardButton("🎮 شروع بازی", callback_data=f"g{gid}:start")])
 
     rows.append([
@@ -417,8 +1908,8 @@ def kb_main(g: sqlite3.Row, uid: int) -> InlineKeyboardMarkup:
         InlineKeyboardButton("❌ پایان بازی", callback_data=f"g{gid}:end"),
     ])
 
-    if g["status"]=="running":
-        can_reroll = rerolls_left(gid, uid)>0
+    if g.status=="running":
+        rerolls = s.viewer.rerolls_left if s.viewer else 0
         if phase=="choose":
             rows.append([
                 InlineKeyboardButton("👀 حقیقت", callback_data=f"g{gid}:pick:truth:normal"),
@@ -430,9 +1921,9 @@ def kb_main(g: sqlite3.Row, uid: int) -> InlineKeyboardMarkup:
                     InlineKeyboardButton("💦 جرأت +18", callback_data=f"g{gid}:pick:dare:18"),
                 ])
             rows.append([InlineKeyboardButton("🎲 انتخاب شانسی", callback_data=f"g{gid}:pick:random:random")])
-            if can_reroll:
-                rows.append([InlineKeyboardButton(f"🔄 تعویض (باقی: {rerolls_left(gid, uid)})", callback_data=f"g{gid}:reroll")])
-            if int(g["show_prev_question"])==1 and (g["last_q_text"] or ""):
+            if rerolls>0:
+                rows.append([InlineKeyboardButton(f"🔄 تعویض (باقی: {rerolls})", callback_data=f"g{gid}:reroll")])
+            if int(g.show_prev_question)==1 and (g.last_q_text or ""):
                 rows.append([InlineKeyboardButton("❓ سوال قبلی", callback_data=f"g{gid}:prev")])
 
         elif phase=="question":
@@ -446,14 +1937,17 @@ def kb_main(g: sqlite3.Row, uid: int) -> InlineKeyboardMarkup:
                 InlineKeyboardButton("👎 رد", callback_data=f"g{gid}:confirm:no"),
             ])
 
-    rows.append([InlineKeyboardButton("⬇️ انتقال به پایین", callback_data=f"g{gid}:bump")])
+    rows.append([
+        InlineKeyboardButton("🚪 خروج از بازی", callback_data=f"g{gid}:leave"),
+        InlineKeyboardButton("⬇️ انتقال به پایین", callback_data=f"g{gid}:bump"),
+    ])
     return InlineKeyboardMarkup(rows)
 
-def kb_settings(g: sqlite3.Row) -> InlineKeyboardMarkup:
-    gid=int(g["id"])
-    allow_mid = int(g["allow_mid_join"])==1
-    show_prev = int(g["show_prev_question"])==1
-    allow18 = int(g["allow_18"])==1
+def kb_settings(g: GameRec) -> InlineKeyboardMarkup:
+    gid=g.id
+    allow_mid = int(g.allow_mid_join)==1
+    show_prev = int(g.show_prev_question)==1
+    allow18 = int(g.allow_18)==1
     rows=[
         [InlineKeyboardButton(f"➕ ورود وسط بازی: {'فعال✅' if allow_mid else 'خاموش❌'}", callback_data=f"g{gid}:set:mid:{'0' if allow_mid else '1'}")],
         [InlineKeyboardButton(f"❓ سوال قبلی: {'فعال✅' if show_prev else 'خاموش❌'}", callback_data=f"g{gid}:set:prev:{'0' if show_prev else '1'}")],
@@ -462,33 +1956,33 @@ def kb_settings(g: sqlite3.Row) -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(rows)
 
-def players_line(gid: int) -> str:
-    ps=list_players(gid)
+def players_line(ps: List[PlayerRec]) -> str:
     if not ps:
         return "—"
     # short list
-    names=[esc(p["name"]) for p in ps[:8]]
+    names=[esc(p.name) for p in ps[:8]]
     extra = f" +{len(ps)-8}" if len(ps)>8 else ""
     return "، ".join(names) + extra
 
-def render_text(g: sqlite3.Row) -> str:
-    gid=int(g["id"])
-    ps=list_players(gid)
-    cp=current_player(g)
-    view=g["view"]
-    status=g["status"]
-    phase=g["phase"]
+def render_text(s: BoardSnapshot) -> str:
+    g=s.game
+    gid=g.id
+    ps=s.players
+    cp=s.current
+    view=g.view
+    status=g.status
+    phase=g.phase
 
     header = "😈 <b>جرأت/حقیقت Pro</b>\n"
     header += f"🆔 <code>{gid}</code> | 🧑‍🤝‍🧑 <b>{len(ps)}</b> نفر | ⏱ <b>{TURN_TIMEOUT_SEC}s</b>\n"
-    header += f"👥 بازیکنان: {players_line(gid)}\n"
+    header += f"👥 بازیکنان: {players_line(ps)}\n"
     header += "— — — — —\n"
 
     if view=="settings":
         body="⚙️ <b>تنظیمات بازی</b>\n"
-        body += f"➕ ورود وسط بازی: {'فعال✅' if int(g['allow_mid_join'])==1 else 'خاموش❌'}\n"
-        body += f"❓ سوال قبلی: {'فعال✅' if int(g['show_prev_question'])==1 else 'خاموش❌'}\n"
-        body += f"🔞 سوالات +18: {'فعال✅' if int(g['allow_18'])==1 else 'خاموش❌'}\n"
+        body += f"➕ ورود وسط بازی: {'فعال✅' if int(g.allow_mid_join)==1 else 'خاموش❌'}\n"
+        body += f"❓ سوال قبلی: {'فعال✅' if int(g.show_prev_question)==1 else 'خاموش❌'}\n"
+        body += f"🔞 سوالات +18: {'فعال✅' if int(g.allow_18)==1 else 'خاموش❌'}\n"
         body += "\n🏠 برای برگشت «پایه» رو بزن."
         return header+body
 
@@ -498,7 +1992,7 @@ def render_text(g: sqlite3.Row) -> str:
             body+="—\n"
         else:
             for i,p in enumerate(ps, start=1):
-                body += f"{i}) {mention(int(p['user_id']), p['name'])} | 🔄{p['rerolls_left']} | ⏭{p['skips_used']} | ⚠️{p['penalties']}\n"
+                body += f"{i}) {mention(p.user_id, p.name)} | 🔄{p.rerolls_left} | ⏭{p.skips_used} | ⚠️{p.penalties}\n"
         body += "\n🏠 برای برگشت «پایه» رو بزن."
         return header+body
 
@@ -506,8 +2000,8 @@ def render_text(g: sqlite3.Row) -> str:
         body="📊 <b>آمار بازی</b>\n"
         if ps:
             for p in ps:
-                body += f"• {mention(int(p['user_id']), p['name'])}: نوبت {p['turns']} | مجازات {p['penalties']} | رد نوبت {p['skips_used']} | تعویض {p['rerolls_left']}\n"
-        lastq = (g["last_q_text"] or "").strip()
+                body += f"• {mention(p.user_id, p.name)}: نوبت {p.turns} | مجازات {p.penalties} | رد نوبت {p.skips_used} | تعویض {p.rerolls_left}\n"
+        lastq = (g.last_q_text or "").strip()
         if lastq:
             body += "\n🧾 <b>آخرین سوال:</b>\n"
             body += f"{esc(lastq[:600])}\n"
@@ -529,7 +2023,7 @@ def render_text(g: sqlite3.Row) -> str:
         return header+"❌ بازیکنی نیست."
 
     body="🔥 <b>بازی شروع شد</b>\n"
-    body += f"👤 نوبت: {mention(int(cp['user_id']), cp['name'])}\n"
+    body += f"👤 نوبت: {mention(cp.user_id, cp.name)}\n"
     body += f"🎛 وضعیت: <b>{'انتخاب' if phase=='choose' else 'سوال' if phase=='question' else 'تأیید'}</b>\n\n"
 
     if phase=="choose":
@@ -537,134 +2031,500 @@ def render_text(g: sqlite3.Row) -> str:
         return header+body
 
     if phase=="question":
-        la=last_action(gid)
-        if la:
-            body += f"📌 <b>{'حقیقت' if la['qtype']=='truth' else 'جرأت'}</b> | سطح: <b>{'18+' if la['level']=='18' else 'معمولی'}</b>\n\n"
-            body += f"❓ {esc(la['text'][:900])}"
+        if s.last:
+            qtype, level, qtext = s.last
+            body += f"📌 <b>{'حقیقت' if qtype=='truth' else 'جرأت'}</b> | سطح: <b>{'18+' if level=='18' else 'معمولی'}</b>\n\n"
+            body += f"❓ {esc(qtext[:900])}"
         else:
             body += "❓ سوالی ثبت نشده."
         return header+body
 
     if phase=="wait_confirm":
-        la=last_action(gid)
         body += "⏳ منتظر تایید طرف مقابل…\n\n"
-        if la:
-            body += f"❓ {esc(la['text'][:700])}"
+        if s.last:
+            body += f"❓ {esc(s.last[2][:700])}"
         return header+body
 
     return header+body
 
+def _top_cursor(r: dict) -> str:
+    return f"{r['confirmations']}:{r['turns']}:{r['user_id']}"
+
+def render_top(chat_id: int, page: int, rows: List[dict], has_prev: bool, has_next: bool) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    text="🏆 <b>جدول برترین‌ها</b>\n"
+    if not rows:
+        return text+"هنوز آماری ثبت نشده.", None
+    for i,r in enumerate(rows, start=page*TOP_PAGE_SIZE+1):
+        text += f"{i}) {mention(int(r['user_id']), r['name'])} | ✅{r['confirmations']} | 🎯{r['turns']} | ❌{r['refusals']} | ⏭{r['skips']} | ⚠️{r['penalties']}\n"
+    nav=[]
+    # the buttons carry the keyset cursor: before this page's first row / after its last
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"top:{chat_id}:{page-1}:p:{_top_cursor(rows[0])}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"top:{chat_id}:{page+1}:n:{_top_cursor(rows[-1])}"))
+    return text, (InlineKeyboardMarkup([nav]) if nav else None)
+
+# =========================
+# Async DB access (هیچ کوئری روی event loop اجرا نمیشه)
+# =========================
+# One dedicated thread owns all SQLite work: handlers never block the event
+# loop on a query or an fsync, and writes are serialized without SQLITE_BUSY.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+def _timed_db(fn, queued: float, args, kwargs):
+    name=getattr(fn, "__name__", "other")
+    t=time.perf_counter()
+    QUEUE_SECONDS.observe(name, t-queued)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        DB_SECONDS.observe(name, time.perf_counter()-t)
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking DB callable on the DB thread and await its result."""
+    loop=asyncio.get_running_loop()
+    # the caller's context goes along, so its statements land on its trace
+    ctx=contextvars.copy_context()
+    return await loop.run_in_executor(DB_EXECUTOR, ctx.run, _timed_db, fn, time.perf_counter(), args, kwargs)
+
+def _awaitable(fn):
+    async def wrapper(*args, **kwargs):
+        return await run_db(fn, *args, **kwargs)
+    wrapper.__name__ = wrapper.__qualname__ = "a"+fn.__name__
+    wrapper.__doc__ = f"Awaitable {fn.__name__}(), executed on the DB thread."
+    return wrapper
+
+aget_game=_awaitable(get_game)
+aget_group_game_by_chat=_awaitable(get_group_game_by_chat)
+aget_game_by_inline_id=_awaitable(get_game_by_inline_id)
+aset_game_fields=_awaitable(set_game_fields)
+aupsert_player=_awaitable(upsert_player)
+aremove_player=_awaitable(remove_player)
+alist_players=_awaitable(list_players)
+aplayer_row=_awaitable(player_row)
+arerolls_left=_awaitable(rerolls_left)
+ainc_stat=_awaitable(inc_stat)
+acurrent_player=_awaitable(current_player)
+aadvance_turn=_awaitable(advance_turn)
+apick_random_question=_awaitable(pick_random_question)
+aqueue_forced=_awaitable(queue_forced)
+apop_forced=_awaitable(pop_forced)
+acreate_action=_awaitable(create_action)
+astart_game=_awaitable(start_game)
+aturn_transition=_awaitable(turn_transition)
+aask_question=_awaitable(ask_question)
+aawait_confirm=_awaitable(await_confirm)
+ause_reroll=_awaitable(use_reroll)
+alast_action=_awaitable(last_action)
+aadd_questions=_awaitable(add_questions)
+apending_suggestions=_awaitable(pending_suggestions)
+areview_suggestion=_awaitable(review_suggestion)
+arunning_games=_awaitable(running_games)
+aset_question_enabled=_awaitable(set_question_enabled)
+adraw_question=_awaitable(draw_question)
+acreate_group_game=_awaitable(create_group_game)
+acreate_inline_game=_awaitable(create_inline_game)
+atop_page=_awaitable(top_page)
+
+def render_board(gid: int, uid_for_kb: int, force_view: Optional[str]=None):
+    """Load + render a board in one DB-thread hop: returns (game, text, markup) or None."""
+    if force_view:
+        set_game_fields(gid, view=force_view)
+    s=load_snapshot(gid, uid_for_kb)
+    if not s:
+        return None
+    markup = kb_settings(s.game) if s.game.view=="settings" else kb_main(s)
+    return s.game, render_text(s), markup
+
+arender_board=_awaitable(render_board)
+
+# =========================
+# Outbound Bot API scheduler (rate limit)
+# =========================
+PRIO_TURN, PRIO_USER, PRIO_ADMIN = 0, 1, 2   # lower is served first
+
+class TokenBucket:
+    __slots__=("rate","burst","tokens","stamp","paused_until")
+    def __init__(self, rate: float, burst: float):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=float(burst)
+        self.stamp=time.monotonic()
+        self.paused_until=0.0
+
+    def wait_time(self, t: float) -> float:
+        """Seconds until one token is available (0 = now)."""
+        if t<self.paused_until:
+            return self.paused_until-t
+        self.tokens=min(self.burst, self.tokens+(t-self.stamp)*self.rate)
+        self.stamp=t
+        return 0.0 if self.tokens>=1 else (1-self.tokens)/self.rate
+
+    def take(self):
+        self.tokens-=1
+
+class OutboundLimiter:
+    """Single scheduler for Bot API sends/edits.
+
+    A call needs a token from the global bucket and from its target's bucket
+    (chat id, or inline_message_id). Waiters are granted in priority order, but
+    a waiter whose chat is throttled does not hold back other chats. A
+    RetryAfter pauses the target's bucket for the full duration it asks for.
+    """
+    def __init__(self):
+        self.glob=TokenBucket(API_GLOBAL_PER_SEC, API_GLOBAL_PER_SEC)
+        self.buckets={}
+        self.waiters=[]  # sorted [(prio, seq, key, future)]
+        self._seq=itertools.count()
+        self._wake: Optional[asyncio.Event]=None
+        self._task: Optional[asyncio.Task]=None
+        self.stats={"granted":0,"queued":0,"retry_after":0}
+
+    def _bucket(self, key) -> TokenBucket:
+        b=self.buckets.get(key)
+        if b is None:
+            if isinstance(key, int) and key<0:
+                b=TokenBucket(API_GROUP_PER_MIN/60.0, API_GROUP_BURST)
+            else:
+                b=TokenBucket(API_CHAT_PER_SEC, API_CHAT_BURST)
+            self.buckets[key]=b
+        return b
+
+    async def acquire(self, key, prio: int=PRIO_USER):
+        t=time.monotonic()
+        b=self._bucket(key)
+        if not self.waiters and self.glob.wait_time(t)==0 and b.wait_time(t)==0:
+            self.glob.take(); b.take()
+            self.stats["granted"]+=1
+            return
+        fut=asyncio.get_running_loop().create_future()
+        entry=(prio, next(self._seq), key, fut)
+        bisect.insort(self.waiters, entry)
+        self.stats["queued"]+=1
+        self._kick()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+            raise
+
+    def penalize(self, key, seconds: float):
+        b=self._bucket(key) if key is not None else self.glob
+        b.paused_until=max(b.paused_until, time.monotonic()+seconds)
+        b.tokens=0.0
+        self.stats["retry_after"]+=1
+
+    def _kick(self):
+        if self._task is None or self._task.done():
+            self._wake=asyncio.Event()
+            self._task=asyncio.create_task(self._pump())
+        else:
+            self._wake.set()
+
+    async def _pump(self):
+        while self.waiters:
+            t=time.monotonic()
+            delay=None
+            i=0
+            while i<len(self.waiters):
+                _, _, key, fut = self.waiters[i]
+                if fut.done():
+                    self.waiters.pop(i); continue
+                gw=self.glob.wait_time(t)
+                if gw>0:
+                    delay=gw if delay is None else min(delay, gw)
+                    break
+                b=self._bucket(key)
+                bw=b.wait_time(t)
+                if bw>0:
+                    delay=bw if delay is None else min(delay, bw)
+                    i+=1; continue
+                self.glob.take(); b.take()
+                self.waiters.pop(i)
+                fut.set_result(None)
+                self.stats["granted"]+=1
+            if not self.waiters:
+                break
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        if len(self.buckets)>API_BUCKETS_MAX:
+            t=time.monotonic()
+            for key in [k for k,b in self.buckets.items() if b.wait_time(t)==0 and b.tokens>=b.burst]:
+                del self.buckets[key]
+
+LIMITER = OutboundLimiter()
+
+async def api_call(key, prio: int, fn, *args, **kwargs):
+    """Call a Bot API method once a send slot for `key` is granted; RetryAfter re-queues the call."""
+    for attempt in range(API_MAX_ATTEMPTS):
+        await LIMITER.acquire(key, prio)
+        try:
+            return await fn(*args, **kwargs)
+        except RetryAfter as e:
+            API_ERRORS.inc("retry_after")
+            wait = float(getattr(e, "retry_after", 1.0))
+            log.warning("RetryAfter %.2fs for %s (attempt %d)", wait, key, attempt+1)
+            LIMITER.penalize(key, wait)
+            if attempt+1>=API_MAX_ATTEMPTS:
+                raise
+
+async def reply(message, text: str, prio: int=PRIO_ADMIN, **kwargs):
+    return await api_call(message.chat_id, prio, message.reply_text, text, **kwargs)
+
 # =========================
 # Robust edit with retry + lock
 # =========================
 async def _edit_message_safe(context: ContextTypes.DEFAULT_TYPE, g: sqlite3.Row, text: str, markup: InlineKeyboardMarkup):
-    # Telegram rate limits / network hiccups => retry
+    # rate limits are handled by api_call; network hiccups => retry
+    if g["kind"]=="group":
+        key=int(g["board_chat_id"])
+        target={"chat_id": key, "message_id": int(g["board_message_id"])}
+    else:
+        key=str(g["board_inline_id"])
+        target={"inline_message_id": key}
+    t=time.perf_counter()
+    try:
+        await _edit_with_retry(context, key, target, text, markup)
+    finally:
+        TG_EDIT_SECONDS.observe(g["kind"], time.perf_counter()-t)
+
+async def _edit_with_retry(context: ContextTypes.DEFAULT_TYPE, key, target: dict, text: str, markup: InlineKeyboardMarkup):
     for attempt in range(4):
         try:
-            if g["kind"]=="group":
-                await context.bot.edit_message_text(
-                    chat_id=int(g["board_chat_id"]),
-                    message_id=int(g["board_message_id"]),
-                    text=text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=markup,
-                    disable_web_page_preview=True,
-                )
-            else:
-                await context.bot.edit_message_text(
-                    inline_message_id=str(g["board_inline_id"]),
-                    text=text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=markup,
-                    disable_web_page_preview=True,
-                )
+            await api_call(
+                key, PRIO_TURN, context.bot.edit_message_text,
+                text=text,
+                parse_mode=ParseMode.HTML,
+                reply_markup=markup,
+                disable_web_page_preview=True,
+                **target,
+            )
             return  # success
-        except RetryAfter as e:
-            wait = float(getattr(e, "retry_after", 1.0))
-            log.warning("RetryAfter %.2fs (attempt %d)", wait, attempt+1)
-            await asyncio.sleep(min(wait, 3.0))
-        except (TimedOut, NetworkError) as e:
-            log.warning("Network/Timeout %s (attempt %d)", e, attempt+1)
-            await asyncio.sleep(0.25 * (attempt+1))
         except BadRequest as e:
+            # BadRequest is a NetworkError subclass, so it has to be caught first
             msg = str(e).lower()
             if "message is not modified" in msg:
+                API_ERRORS.inc("not_modified")
                 return
             # inline sometimes: "message can't be edited"
+            API_ERRORS.inc("bad_request")
             log.error("BadRequest edit: %s", e)
             raise
+        except (TimedOut, NetworkError) as e:
+            API_ERRORS.inc("timed_out" if isinstance(e, TimedOut) else "network")
+            log.warning("Network/Timeout %s (attempt %d)", e, attempt+1)
+            await asyncio.sleep(0.25 * (attempt+1))
     raise RuntimeError("Failed to edit message after retries")
 
-async def edit_board(context: ContextTypes.DEFAULT_TYPE, g: sqlite3.Row, uid_for_kb: int, force_view: Optional[str]=None):
-    gid=int(g["id"])
-    lock = game_lock(context.application, gid)
-
-    async with lock:
-        if force_view:
-            set_game_fields(gid, view=force_view)
-        g = get_game(gid)
-        if not g:
-            return
-
-        text = render_text(g)
-        markup = kb_settings(g) if g["view"]=="settings" else kb_main(g, uid_for_kb)
-
+def board_fingerprint(g: sqlite3.Row, text: str, markup: InlineKeyboardMarkup) -> bytes:
+    # the board identity is part of the digest, so a moved/re-sent board never matches
+    board = f"{g['board_chat_id']}:{g['board_message_id']}" if g["kind"]=="group" else str(g["board_inline_id"])
+    h=hashlib.blake2b(digest_size=16)
+    h.update(board.encode()); h.update(b"\0")
+    h.update(text.encode()); h.update(b"\0")
+    h.update(json.dumps(markup.to_dict(), sort_keys=True, ensure_ascii=False).encode())
+    return h.digest()
+
+async def _send_board(context: ContextTypes.DEFAULT_TYPE, gid: int, uid_for_kb: int) -> bool:
+    async with game_lock(context.application, gid):
+        rendered = await arender_board(gid, uid_for_kb)
+        if not rendered:
+            return False
+        g, text, markup = rendered
+
+        # last successfully sent render per board; in memory only, so a restart
+        # or any failure falls back to a real edit
+        rt = RUNTIME.get(gid)
+        fp = board_fingerprint(g, text, markup)
+        if rt.fingerprint==fp:
+            EDIT_STATS["skipped"]+=1
+            return False
+        rt.fingerprint = None
         try:
             await _edit_message_safe(context, g, text, markup)
+            rt.fingerprint = fp
         except BadRequest:
             # group fallback: create new board if old isn't editable anymore
             if g["kind"]=="group":
                 try:
-                    msg = await context.bot.send_message(
+                    msg = await api_call(
+                        int(g["board_chat_id"]), PRIO_TURN, context.bot.send_message,
                         chat_id=int(g["board_chat_id"]),
                         text=text,
                         parse_mode=ParseMode.HTML,
                         reply_markup=markup,
                         disable_web_page_preview=True,
                     )
-                    set_game_fields(gid, board_message_id=msg.message_id)
+                    await aset_game_fields(gid, board_message_id=msg.message_id)
+                    API_ERRORS.inc("group_fallback")
                 except Exception as e:
                     log.error("Group fallback send failed: %s", e)
+        return True
 
 # =========================
-# TIMEOUT Job
+# Coalesced board edits (هر بازی حداکثر یک ادیت در صف)
 # =========================
-def schedule_timeout(context: ContextTypes.DEFAULT_TYPE, gid: int, actor_id: int):
-    key=f"timeout:{gid}"
-    job=context.application.bot_data.get(key)
-    if job:
-        try: job.schedule_removal()
-        except Exception: pass
-    context.application.bot_data[key]=context.job_queue.run_once(
-        timeout_job, when=TURN_TIMEOUT_SEC, data={"gid":gid,"actor":actor_id}, name=key
-    )
+EDIT_STATS = {"requested": 0, "sent": 0, "coalesced": 0, "skipped": 0}
+
+class BoardEditState:
+    """Pending edit of one board: `dirty` means a newer state than the last render exists."""
+    __slots__=("dirty","uid","task")
+    def __init__(self):
+        self.dirty=False
+        self.uid=0
+        self.task: Optional[asyncio.Task]=None
+
+async def _board_edit_worker(context: ContextTypes.DEFAULT_TYPE, gid: int, st: BoardEditState):
+    rt = RUNTIME.get(gid)
+    try:
+        while st.dirty:
+            st.dirty=False
+            t=time.perf_counter()
+            result="failed"
+            try:
+                if await _send_board(context, gid, st.uid):
+                    EDIT_STATS["sent"]+=1
+                    result="sent"
+                else:
+                    result="skipped"
+            except Exception as e:
+                log.error("Board edit failed (game %s): %s", gid, e)
+            BOARD_EDIT_SECONDS.observe(result, time.perf_counter()-t)
+            # the first edit went out at once; requests within EDIT_DEBOUNCE_SEC of it collapse into one follow-up
+            await asyncio.sleep(EDIT_DEBOUNCE_SEC)
+    finally:
+        st.task=None
+        if not st.dirty and rt.edit is st:
+            rt.edit=None
+
+async def edit_board(context: ContextTypes.DEFAULT_TYPE, g: sqlite3.Row, uid_for_kb: int, force_view: Optional[str]=None):
+    """Schedule a board refresh. An idle board is edited right away; requests that arrive while
+    an edit is pending or within EDIT_DEBOUNCE_SEC after one collapse into a single follow-up,
+    which always renders the latest state."""
+    gid=int(g["id"])
+    if force_view:
+        await aset_game_fields(gid, view=force_view)
+
+    rt = RUNTIME.get(gid)
+    st = rt.edit
+    if st is None:
+        st = rt.edit = BoardEditState()
+    EDIT_STATS["requested"]+=1
+    if st.dirty:
+        EDIT_STATS["coalesced"]+=1
+    st.dirty=True
+    st.uid=uid_for_kb
+    if st.task is None:
+        st.task=asyncio.create_task(_board_edit_worker(context, gid, st))
+
+# =========================
+# TIMEOUT scheduler (deadline ها توی دیتابیس، یک تسک برای همه بازی‌ها)
+# =========================
+class TurnTimers:
+    """Drives every turn deadline from one min-heap and one task.
+
+    Rescheduling only pushes a new entry and overwrites due[gid]; entries that
+    no longer match due[] are dropped when they reach the top (lazy invalidation).
+    """
+    def __init__(self):
+        self.heap=[]   # [(deadline, gid, actor)]
+        self.due={}    # gid -> (deadline, actor)
+        self.app: Optional[Application]=None
+        self.firing=set()
+        self._wake: Optional[asyncio.Event]=None
+        self._task: Optional[asyncio.Task]=None
+        self.stats={"scheduled":0,"fired":0,"stale":0,"recovered":0}
+
+    def push(self, gid: int, actor: int, deadline: float):
+        self.due[gid]=(deadline, actor)
+        entry=(deadline, gid, actor)
+        heapq.heappush(self.heap, entry)
+        self.stats["scheduled"]+=1
+        if len(self.heap)>2*len(self.due)+64:
+            self.heap=[(d, g, a) for g, (d, a) in self.due.items()]
+            heapq.heapify(self.heap)
+        if self._wake is not None and self.heap[0]==entry:
+            self._wake.set()
+
+    def cancel(self, gid: int):
+        self.due.pop(gid, None)
+
+    def start(self, app: Application) -> asyncio.Task:
+        self.app=app
+        self._wake=asyncio.Event()
+        self._task=asyncio.create_task(self._run())
+        return self._task
+
+    async def _run(self):
+        while True:
+            t=time.time()
+            while self.heap and self.heap[0][0]<=t:
+                deadline, gid, actor = heapq.heappop(self.heap)
+                if self.due.get(gid)!=(deadline, actor):
+                    self.stats["stale"]+=1
+                    continue
+                del self.due[gid]
+                self.stats["fired"]+=1
+                task=asyncio.create_task(fire_timeout(self.app, gid, actor))
+                self.firing.add(task)
+                task.add_done_callback(self.firing.discard)
+            delay=self.heap[0][0]-t if self.heap else None
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+TIMERS = TurnTimers()
+
+def recover_deadlines() -> List[Tuple[int, int, float]]:
+    """(gid, actor, deadline) for every running game; a missing or stale deadline restarts the turn clock."""
+    out=[]
+    with CACHE._lock:
+        for gid, g in list(CACHE.games.items()):
+            if g["status"]!="running" or g["turn_uid"] is None:
+                continue
+            deadline, actor = g["turn_deadline"], g["turn_actor"]
+            if deadline is None or actor!=g["turn_uid"]:
+                deadline, actor = time.time()+TURN_TIMEOUT_SEC, g["turn_uid"]
+                set_game_fields(gid, turn_deadline=deadline, turn_actor=actor)
+            out.append((gid, int(actor), float(deadline)))
+    return out
+
+async def schedule_timeout(context: ContextTypes.DEFAULT_TYPE, gid: int, actor_id: int):
+    deadline=time.time()+TURN_TIMEOUT_SEC
+    await aset_game_fields(gid, turn_deadline=deadline, turn_actor=actor_id)
+    TIMERS.push(gid, actor_id, deadline)
+
+async def fire_timeout(app: Application, gid: int, actor: int):
+    try:
+        await timeout_job(app.context_types.context(app), gid, actor)
+    except Exception as e:
+        log.error("Turn timeout of game %s failed: %s", gid, e)
 
-async def timeout_job(context: ContextTypes.DEFAULT_TYPE):
-    data=context.job.data or {}
-    gid=int(data.get("gid",0))
-    actor=int(data.get("actor",0))
-    g=get_game(gid)
+async def timeout_job(context: ContextTypes.DEFAULT_TYPE, gid: int, actor: int):
+    g=await aget_game(gid)
     if not g or g["status"]!="running":
         return
-    cp=current_player(g)
+    # rescheduled for the same player (pick/reroll) after this deadline was set
+    if g["turn_actor"]!=actor or (g["turn_deadline"] or 0)>time.time():
+        return
+    cp=await acurrent_player(g)
     if not cp or int(cp["user_id"])!=actor:
         return
 
     penalty=random.choice(PENALTIES)
-    inc_stat(gid, actor, "penalties", 1)
-    if rerolls_left(gid, actor)>0 and random.random()<0.5:
-        dec_reroll(gid, actor)
-
-    create_action(gid, actor, "timeout", "normal", f"TIMEOUT | {penalty}", "timeout")
-    advance_turn(gid)
-    set_game_fields(gid, view="main", phase="choose")
-
-    g=get_game(gid)
+    g, new_cp = await aturn_transition(
+        gid, actor, stat="penalties", reroll_loss=0.5,
+        action=("timeout", "normal", f"TIMEOUT | {penalty}", "timeout"),
+    )
     if g:
-        new_cp=current_player(g)
         if new_cp:
-            inc_stat(gid, int(new_cp["user_id"]), "turns", 1)
-            schedule_timeout(context, gid, int(new_cp["user_id"]))
+            await schedule_timeout(context, gid, int(new_cp["user_id"]))
         await edit_board(context, g, uid_for_kb=actor)
 
 # =========================
@@ -695,14 +2555,17 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat.type=="private":
         me=(await context.bot.get_me()).username
         link=f"https://t.me/{me}?startgroup=true"
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "🎲 جرأت/حقیقت Pro\n\n"
             "✅ بازی در پی‌وی دو نفره (داخل همان چت):\n"
             f"داخل چت دونفره بنویس: @{me}\n"
             "و «شروع بازی» رو انتخاب کن.\n\n"
             "✅ بازی در گروه:\n"
             "/startgame\n\n"
+            "🏆 جدول برترین‌ها: /top\n\n"
             f"📤 لینک اضافه‌کردن به گروه:\n{link}",
+            PRIO_USER,
             disable_web_page_preview=True,
         )
 
@@ -710,14 +2573,49 @@ async def cmd_startgame(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat=update.effective_chat
     user=update.effective_user
     if chat.type not in ("group","supergroup"):
-        await update.message.reply_text("این دستور مخصوص گروهه.")
+        await reply(update.message, "این دستور مخصوص گروهه.", PRIO_USER)
         return
-    msg = await update.message.reply_text("⏳ در حال ساخت برد بازی…")
-    gid = create_group_game(chat.id, user.id, msg.message_id)
-    upsert_player(gid, user.id, user.full_name)
-    g=get_game(gid)
+    msg = await reply(update.message, "⏳ در حال ساخت برد بازی…", PRIO_TURN)
+    gid = await acreate_group_game(chat.id, user.id, msg.message_id)
+    await aupsert_player(gid, user.id, user.full_name)
+    g=await aget_game(gid)
     await edit_board(context, g, uid_for_kb=user.id)
 
+async def cmd_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat=update.effective_chat
+    chat_id=chat.id if chat.type in ("group","supergroup") else 0
+    rows, has_next = await atop_page(chat_id)
+    text, markup = render_top(chat_id, 0, rows, False, has_next)
+    await reply(update.message, text, PRIO_USER, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+async def top_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q=update.callback_query
+    m=re.match(r"^top:(-?\d+):(\d+)(?::([np]):(\d+):(\d+):(\d+))?$", q.data or "")
+    if not m:
+        await q.answer()
+        return
+    chat_id=int(m.group(1)); page=int(m.group(2))
+    if not m.group(3):
+        # first page (or a button from before keyset paging)
+        page=0
+        rows, has_next = await atop_page(chat_id)
+        has_prev=False
+    elif m.group(3)=="n":
+        rows, has_next = await atop_page(chat_id, (int(m.group(4)), int(m.group(5)), int(m.group(6))))
+        has_prev=page>0
+    else:
+        rows, has_prev = await atop_page(chat_id, (int(m.group(4)), int(m.group(5)), int(m.group(6))), back=True)
+        has_next=True
+        if not has_prev:
+            page=0
+    text, markup = render_top(chat_id, page, rows, has_prev, has_next)
+    await q.answer()
+    try:
+        await api_call(q.message.chat_id if q.message else chat_id, PRIO_USER, q.edit_message_text,
+                       text=text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except BadRequest:
+        pass
+
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     result = InlineQueryResultArticle(
         id="start_game",
@@ -728,7 +2626,43 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.inline_query.answer([result], cache_time=0, is_personal=True)
 
+CALLBACK_RE = re.compile(r"^g(\d+)\:(.+)$")
+
+def parse_callback(data: str) -> Optional[Tuple[int, str]]:
+    """'g{gid}:{action}' -> (gid, action)."""
+    m=CALLBACK_RE.match(data)
+    return (int(m.group(1)), m.group(2)) if m else None
+
+STALE_CLICK="این دکمه دیگه معتبر نیست."
+CALLBACK_ACTIONS = {"join","start","end","bump","prev","pick","reroll","skip","refuse","done","confirm","view","set","leave"}
+
+def callback_action(data: str) -> str:
+    """Bounded metrics label for a callback: 'g12:pick:truth:normal' -> 'pick'."""
+    head, _, rest = data.partition(":")
+    if head!="new" and not (head[:1]=="g" and head[1:].isdigit()):
+        return "other"
+    action=rest.split(":",1)[0]
+    return action if action in CALLBACK_ACTIONS else "other"
+
 async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data=update.callback_query.data or ""
+    action=callback_action(data)
+    tr=prof=None
+    if TRACE_SLOW_MS>0 and (TRACE_SAMPLE>=1 or random.random()<TRACE_SAMPLE):
+        parsed=parse_callback(data)
+        tr=Trace(action, parsed[0] if parsed else None)
+        token=TRACE.set(tr)
+        prof=PROFILER.start()
+    t=time.perf_counter()
+    try:
+        await _callback_router(update, context)
+    finally:
+        CALLBACK_SECONDS.observe(action, time.perf_counter()-t)
+        if tr is not None:
+            TRACE.reset(token)
+            trace_finish(tr, prof)
+
+async def _callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q=update.callback_query
     user=update.effective_user
     data=q.data or ""
@@ -745,28 +2679,21 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("این بخش فقط برای بازی داخل چت (inline) است.", show_alert=True)
             return
         inline_id=q.inline_message_id
-        g=get_game_by_inline_id(inline_id)
+        g=await aget_game_by_inline_id(inline_id)
         if not g:
             # Create new inline game
-            conn=db(); cur=conn.cursor()
-            cur.execute("""
-              INSERT INTO games (kind,status,owner_id,board_inline_id,created_at)
-              VALUES ('inline','lobby',?,?,?);
-            """,(user.id, inline_id, now()))
-            gid=int(cur.lastrowid)
-            conn.commit(); conn.close()
-            upsert_player(gid, user.id, user.full_name)
-            g=get_game(gid)
+            gid=await acreate_inline_game(user.id, inline_id)
+            await aupsert_player(gid, user.id, user.full_name)
+            g=await aget_game(gid)
         gid=int(g["id"])
         data = data.replace("new:", f"g{gid}:")
 
-    m=re.match(r"^g(\d+)\:(.+)$", data)
-    if not m:
+    parsed=parse_callback(data)
+    if not parsed:
         return
-    gid=int(m.group(1))
-    action=m.group(2)
+    gid, action = parsed
 
-    g=get_game(gid)
+    g=await aget_game(gid)
     if not g or g["status"]=="ended":
         await q.answer("این بازی پایان یافته یا وجود ندارد.", show_alert=True)
         return
@@ -786,8 +2713,8 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         view=action.split(":",1)[1]
         if view not in ("main","settings","players","stats"):
             return
-        set_game_fields(gid, view=view)
-        await edit_board(context, get_game(gid), uid_for_kb=user.id)
+        await aset_game_fields(gid, view=view)
+        await edit_board(context, await aget_game(gid), uid_for_kb=user.id)
         return
 
     # settings toggles
@@ -797,13 +2724,13 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         _, key, val = action.split(":")
         if key=="mid":
-            set_game_fields(gid, allow_mid_join=int(val))
+            await aset_game_fields(gid, allow_mid_join=int(val))
         elif key=="prev":
-            set_game_fields(gid, show_prev_question=int(val))
+            await aset_game_fields(gid, show_prev_question=int(val))
         elif key=="18":
-            set_game_fields(gid, allow_18=int(val))
-        set_game_fields(gid, view="settings")
-        await edit_board(context, get_game(gid), uid_for_kb=user.id)
+            await aset_game_fields(gid, allow_18=int(val))
+        await aset_game_fields(gid, view="settings")
+        await edit_board(context, await aget_game(gid), uid_for_kb=user.id)
         return
 
     # join
@@ -811,9 +2738,21 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if g["status"]=="running" and int(g["allow_mid_join"])==0:
             await q.answer("ورود وسط بازی خاموشه.", show_alert=False)
             return
-        created = upsert_player(gid, user.id, user.full_name)
+        created = await aupsert_player(gid, user.id, user.full_name)
         await q.answer("✅ عضو شدی" if created else "✅ قبلاً عضو بودی", show_alert=False)
-        await edit_board(context, get_game(gid), uid_for_kb=user.id)
+        await edit_board(context, await aget_game(gid), uid_for_kb=user.id)
+        return
+
+    # leave
+    if action=="leave":
+        removed, new_cp = await aremove_player(gid, user.id)
+        if not removed:
+            await q.answer("عضو این بازی نیستی.", show_alert=False)
+            return
+        if new_cp:
+            await schedule_timeout(context, gid, int(new_cp["user_id"]))
+        await q.answer("👋 از بازی خارج شدی", show_alert=False)
+        await edit_board(context, await aget_game(gid), uid_for_kb=user.id)
         return
 
     # start (ONLY OWNER)
@@ -821,16 +2760,13 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user.id!=int(g["owner_id"]) and not is_admin(user.id):
             await q.answer("⛔ فقط سازنده می‌تونه شروع کنه.", show_alert=False)
             return
-        players=list_players(gid)
+        players=await alist_players(gid)
         if len(players)<2:
             await q.answer("حداقل ۲ نفر باید Join کنن.", show_alert=False)
             return
-        set_game_fields(gid, status="running", view="main", phase="choose")
-        g=get_game(gid)
-        cp=current_player(g)
+        g, cp = await astart_game(gid)
         if cp:
-            inc_stat(gid, int(cp["user_id"]), "turns", 1)
-            schedule_timeout(context, gid, int(cp["user_id"]))
+            await schedule_timeout(context, gid, int(cp["user_id"]))
         await q.answer("🔥 بازی شروع شد", show_alert=False)
         await edit_board(context, g, uid_for_kb=user.id)
         return
@@ -840,8 +2776,9 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user.id!=int(g["owner_id"]) and not is_admin(user.id):
             await q.answer("⛔ فقط سازنده می‌تونه پایان بده.", show_alert=False)
             return
-        set_game_fields(gid, status="ended", view="main")
-        await edit_board(context, get_game(gid), uid_for_kb=user.id)
+        await aset_game_fields(gid, status="ended", ended_at=now(), view="main")
+        TIMERS.cancel(gid)
+        await edit_board(context, await aget_game(gid), uid_for_kb=user.id)
         return
 
     # bump
@@ -849,22 +2786,24 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if g["kind"]=="group":
             try:
                 try:
-                    await context.bot.edit_message_reply_markup(
+                    await api_call(
+                        int(g["board_chat_id"]), PRIO_TURN, context.bot.edit_message_reply_markup,
                         chat_id=int(g["board_chat_id"]),
                         message_id=int(g["board_message_id"]),
                         reply_markup=None,
                     )
                 except Exception:
                     pass
-                g=get_game(gid)
-                msg=await context.bot.send_message(
+                g, text, markup = await arender_board(gid, user.id)
+                msg=await api_call(
+                    int(g["board_chat_id"]), PRIO_TURN, context.bot.send_message,
                     chat_id=int(g["board_chat_id"]),
-                    text=render_text(g),
+                    text=text,
                     parse_mode=ParseMode.HTML,
-                    reply_markup=kb_settings(g) if g["view"]=="settings" else kb_main(g, user.id),
+                    reply_markup=markup,
                     disable_web_page_preview=True,
                 )
-                set_game_fields(gid, board_message_id=msg.message_id)
+                await aset_game_fields(gid, board_message_id=msg.message_id)
                 await q.answer("✅ منتقل شد", show_alert=False)
             except Exception:
                 await q.answer("نتونستم منتقل کنم.", show_alert=False)
@@ -885,44 +2824,43 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if g["status"]!="running":
             await q.answer("بازی شروع نشده.", show_alert=False)
             return
-        cp=current_player(g)
+        cp=await acurrent_player(g)
         if not cp:
             return
         if user.id not in (int(g["owner_id"]), int(cp["user_id"])) and not is_admin(user.id):
             await q.answer("⛔ اجازه رد نوبت نداری.", show_alert=False)
             return
-        inc_stat(gid, int(cp["user_id"]), "skips_used", 1)
-        advance_turn(gid)
-        set_game_fields(gid, phase="choose", view="main")
-        g=get_game(gid)
-        new_cp=current_player(g)
+        g, new_cp = await aturn_transition(gid, int(cp["user_id"]), stat="skips_used")
         if new_cp:
-            inc_stat(gid, int(new_cp["user_id"]), "turns", 1)
-            schedule_timeout(context, gid, int(new_cp["user_id"]))
-        await edit_board(context, g, uid_for_kb=user.id)
+            await schedule_timeout(context, gid, int(new_cp["user_id"]))
+        if g:
+            await edit_board(context, g, uid_for_kb=user.id)
         return
 
     # reroll (only current player)
     if action=="reroll":
         if g["status"]!="running":
             return
-        cp=current_player(g)
+        cp=await acurrent_player(g)
         if not cp or user.id!=int(cp["user_id"]):
             await q.answer("الان نوبت تو نیست.", show_alert=False)
             return
-        if rerolls_left(gid, user.id)<=0:
+        if await arerolls_left(gid, user.id)<=0:
             await q.answer("تعویضت تموم شده.", show_alert=False)
             return
-        dec_reroll(gid, user.id)
-        schedule_timeout(context, gid, user.id)
-        await edit_board(context, get_game(gid), uid_for_kb=user.id)
+        g=await ause_reroll(gid, user.id)
+        if not g:
+            await q.answer(STALE_CLICK, show_alert=False)
+            return
+        await schedule_timeout(context, gid, user.id)
+        await edit_board(context, g, uid_for_kb=user.id)
         return
 
     # pick question
     if action.startswith("pick:"):
         if g["status"]!="running":
             return
-        cp=current_player(g)
+        cp=await acurrent_player(g)
         if not cp or user.id!=int(cp["user_id"]):
             await q.answer("الان نوبت تو نیست.", show_alert=False)
             return
@@ -934,48 +2872,43 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if level=="18" and int(g["allow_18"])==0:
             await q.answer("+18 خاموشه.", show_alert=False)
             return
+        if g["phase"]!="choose":
+            # checked again by ask_question; this only keeps a double click from using up a forced question
+            await q.answer(STALE_CLICK, show_alert=False)
+            return
 
-        forced = pop_forced(gid, user.id, qtype, level)
-        text = forced or pick_random_question(qtype, level)
+        forced = await apop_forced(gid, user.id, qtype, level)
+        text = forced or await adraw_question(gid, qtype, level)
         if not text:
             await q.answer("سوال نداریم. با Bulk اضافه کن.", show_alert=True)
             return
 
-        set_game_fields(
-            gid,
-            phase="question",
-            last_q_text=text,
-            last_q_by=user.id,
-            last_qtype=qtype,
-            last_level=level,
-            view="main",
-        )
-        create_action(gid, user.id, qtype, level, text, "asked")
-        schedule_timeout(context, gid, user.id)
-        await edit_board(context, get_game(gid), uid_for_kb=user.id)
+        g=await aask_question(gid, user.id, qtype, level, text)
+        if not g:
+            await q.answer(STALE_CLICK, show_alert=False)
+            return
+        await schedule_timeout(context, gid, user.id)
+        await edit_board(context, g, uid_for_kb=user.id)
         return
 
     # refuse
     if action=="refuse":
         if g["status"]!="running":
             return
-        cp=current_player(g)
+        cp=await acurrent_player(g)
         if not cp or user.id!=int(cp["user_id"]):
             await q.answer("الان نوبت تو نیست.", show_alert=False)
             return
         penalty=random.choice(PENALTIES)
-        inc_stat(gid, user.id, "penalties", 1)
-        if rerolls_left(gid, user.id)>0 and random.random()<0.7:
-            dec_reroll(gid, user.id)
-        create_action(gid, user.id, "refuse", "normal", penalty, "refused")
-
-        advance_turn(gid)
-        set_game_fields(gid, phase="choose", view="main")
-        g=get_game(gid)
-        new_cp=current_player(g)
+        g, new_cp = await aturn_transition(
+            gid, user.id, stat="penalties", reroll_loss=0.7,
+            action=("refuse", "normal", penalty, "refused"), phase="question",
+        )
+        if not g:
+            await q.answer(STALE_CLICK, show_alert=False)
+            return
         if new_cp:
-            inc_stat(gid, int(new_cp["user_id"]), "turns", 1)
-            schedule_timeout(context, gid, int(new_cp["user_id"]))
+            await schedule_timeout(context, gid, int(new_cp["user_id"]))
         await edit_board(context, g, uid_for_kb=user.id)
         return
 
@@ -983,38 +2916,29 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if action=="done":
         if g["status"]!="running":
             return
-        cp=current_player(g)
+        cp=await acurrent_player(g)
         if not cp or user.id!=int(cp["user_id"]):
             await q.answer("الان نوبت تو نیست.", show_alert=False)
             return
 
-        players=list_players(gid)
+        players=await alist_players(gid)
         # inline 2-player: need confirm
         if g["kind"]=="inline" and len(players)==2:
-            set_game_fields(gid, phase="wait_confirm", view="main")
-            la=last_action(gid)
-            if la:
-                conn=db(); cur=conn.cursor()
-                cur.execute("UPDATE actions SET status='done_wait' WHERE id=?;",(int(la["id"]),))
-                conn.commit(); conn.close()
-            schedule_timeout(context, gid, user.id)
-            await edit_board(context, get_game(gid), uid_for_kb=user.id)
+            g=await aawait_confirm(gid, user.id)
+            if not g:
+                await q.answer(STALE_CLICK, show_alert=False)
+                return
+            await schedule_timeout(context, gid, user.id)
+            await edit_board(context, g, uid_for_kb=user.id)
             return
 
         # others: self report
-        la=last_action(gid)
-        if la:
-            conn=db(); cur=conn.cursor()
-            cur.execute("UPDATE actions SET status='confirmed' WHERE id=?;",(int(la["id"]),))
-            conn.commit(); conn.close()
-
-        advance_turn(gid)
-        set_game_fields(gid, phase="choose", view="main")
-        g=get_game(gid)
-        new_cp=current_player(g)
+        g, new_cp = await aturn_transition(gid, user.id, last_status="confirmed", phase="question")
+        if not g:
+            await q.answer(STALE_CLICK, show_alert=False)
+            return
         if new_cp:
-            inc_stat(gid, int(new_cp["user_id"]), "turns", 1)
-            schedule_timeout(context, gid, int(new_cp["user_id"]))
+            await schedule_timeout(context, gid, int(new_cp["user_id"]))
         await edit_board(context, g, uid_for_kb=user.id)
         return
 
@@ -1022,11 +2946,11 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if action.startswith("confirm:"):
         if g["status"]!="running":
             return
-        players=list_players(gid)
+        players=await alist_players(gid)
         if len(players)!=2:
             await q.answer("این تایید فقط برای دو نفره‌ست.", show_alert=False)
             return
-        cp=current_player(g)
+        cp=await acurrent_player(g)
         actor=int(cp["user_id"])
         counterpart = [p for p in players if int(p["user_id"])!=actor][0]
         if user.id != int(counterpart["user_id"]):
@@ -1034,30 +2958,21 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         decision = action.split(":")[1]
-        la=last_action(gid)
-        if la:
-            conn=db(); cur=conn.cursor()
-            cur.execute("UPDATE actions SET status=? WHERE id=?;", ("confirmed" if decision=="yes" else "rejected", int(la["id"])))
-            conn.commit(); conn.close()
-
         if decision=="no":
             penalty=random.choice(PENALTIES)
-            inc_stat(gid, actor, "penalties", 1)
-            if rerolls_left(gid, actor)>0 and random.random()<0.7:
-                dec_reroll(gid, actor)
-            create_action(gid, actor, "reject", "normal", penalty, "rejected")
+            g, new_cp = await aturn_transition(
+                gid, actor, stat="penalties", reroll_loss=0.7, last_status="rejected",
+                action=("reject", "normal", penalty, "rejected"), phase="wait_confirm",
+            )
             await q.answer("👎 رد شد + مجازات", show_alert=False)
         else:
+            g, new_cp = await aturn_transition(gid, actor, last_status="confirmed", phase="wait_confirm")
             await q.answer("👍 تایید شد", show_alert=False)
 
-        advance_turn(gid)
-        set_game_fields(gid, phase="choose", view="main")
-        g=get_game(gid)
-        new_cp=current_player(g)
         if new_cp:
-            inc_stat(gid, int(new_cp["user_id"]), "turns", 1)
-            schedule_timeout(context, gid, int(new_cp["user_id"]))
-        await edit_board(context, g, uid_for_kb=user.id)
+            await schedule_timeout(context, gid, int(new_cp["user_id"]))
+        if g:
+            await edit_board(context, g, uid_for_kb=user.id)
         return
 
 # =========================
@@ -1074,20 +2989,49 @@ def flow_get(context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
-        await update.message.reply_text("⛔️ دسترسی نداری")
+        await reply(update.message, "⛔️ دسترسی نداری")
         return
-    await update.message.reply_text(
+    await reply(
+        update.message,
         "👑 پنل ادمین\n"
         "/bulk_truth  یا /bulk_dare  یا /bulk_truth18  یا /bulk_dare18\n"
         "/pending  (پیشنهادها)\n"
         "/force  (سؤال مخفی برای بازیکن)\n"
+        "/disable <id>  (غیرفعال کردن سؤال)\n"
+        "/perf  (آمار عملکرد)\n"
+    )
+
+async def cmd_perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    # both stats() take locks the DB thread holds across queries: read them there
+    s=POOL.stats(); c=await run_db(CACHE.stats); sampler=await run_db(SAMPLER.stats); w=WRITER.summary()
+    await reply(
+        update.message,
+        "📈 Perf\n"
+        f"DB pool: size={s['size']} idle={s['idle']} opened={s['opened']} reused={s['reused']}\n"
+        f"Game cache: games={c['games']} pending={c['pending']} flushes={c['flushes']} flushed={c['flushed']}\n"
+        f"Group commit (60s): {w['rate']}/s batch p50={w['p50']} p95={w['p95']} max={w['max']} kicks={WRITER.stats}\n"
+        f"Question sampler: {sampler}\n"
+        f"Board edits: requested={EDIT_STATS['requested']} sent={EDIT_STATS['sent']} coalesced={EDIT_STATS['coalesced']} skipped={EDIT_STATS['skipped']}\n"
+        f"Bot API: granted={LIMITER.stats['granted']} queued={LIMITER.stats['queued']} retry_after={LIMITER.stats['retry_after']} waiting={len(LIMITER.waiters)}\n"
+        f"Game runtimes: live={len(RUNTIME.games)} created={RUNTIME.stats['created']} freed_ended={RUNTIME.stats['freed_ended']} freed_idle={RUNTIME.stats['freed_idle']}\n"
+        f"Retention: runs={RETENTION_STATS['runs']} idle_ended={RETENTION_STATS['idle_ended']} archived={RETENTION_STATS['archived']} purged={RETENTION_STATS['purged_rows']} forced={RETENTION_STATS['forced_purged']} vacuumed_pages={RETENTION_STATS['vacuumed_pages']}\n"
+        f"Turn timers: pending={len(TIMERS.due)} heap={len(TIMERS.heap)} fired={TIMERS.stats['fired']} stale={TIMERS.stats['stale']} recovered={TIMERS.stats['recovered']}\n"
+        + f"Updates: lanes={len(UPDATES.lanes)} {UPDATES.stats}\n"
+        + (f"Webhook: {WEBHOOK_STATS}\n" if WEBHOOK_URL else "")
+        + (f"Shared DB: {CAS_STATS}\n" if SHARED_DB else "")
+        + (f"Shards: {DB_SHARDS} " + " ".join(f"[{n}] opened={p.stats()['opened']} reused={p.stats()['reused']}" for n,p in enumerate(SHARDS)) + "\n" if SHARDS else "")
+        + f"Tracing: traced={TRACE_STATS['traced']} slow={TRACE_STATS['slow']} (>{TRACE_SLOW_MS:.0f}ms) profiles={TRACE_STATS['profiles']}"
+        + "".join(f"\n• {line}" for line in list(SLOW_LOG)[-3:])
     )
 
 async def cmd_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, qtype: str, level: str):
     if not is_admin(update.effective_user.id):
         return
     flow_set(context,"bulk",{"qtype":qtype,"level":level})
-    await update.message.reply_text(
+    await reply(
+        update.message,
         f"➕ Bulk Add برای {qtype}/{level}\n"
         "چند سوال رو یکجا بفرست:\n"
         "1= ...\n2= ...\n3= ...\n"
@@ -1097,37 +3041,43 @@ async def cmd_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, qtype: st
 async def cmd_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT * FROM suggestions WHERE status='pending' ORDER BY id ASC LIMIT 10;")
-    rows=cur.fetchall(); conn.close()
+    rows=await apending_suggestions(10)
     if not rows:
-        await update.message.reply_text("✅ چیزی در صف نیست.")
+        await reply(update.message, "✅ چیزی در صف نیست.")
         return
     for r in rows:
         kb=InlineKeyboardMarkup([[
             InlineKeyboardButton("✅ تایید", callback_data=f"adm:ap:{r['id']}"),
             InlineKeyboardButton("❌ رد", callback_data=f"adm:rj:{r['id']}"),
         ]])
-        await update.message.reply_text(
+        await reply(
+            update.message,
             f"پیشنهاد #{r['id']}\n"
             f"از {r['user_id']} | {r['qtype']}/{r['level']}\n\n"
             f"{r['text']}",
             reply_markup=kb
         )
 
+async def cmd_disable(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    if not context.args or not context.args[0].isdigit():
+        await reply(update.message, "استفاده: /disable <id>")
+        return
+    r=await aset_question_enabled(int(context.args[0]), False)
+    await reply(update.message, "✅ غیرفعال شد." if r else "سؤال پیدا نشد.")
+
 async def cmd_force(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    conn=db(); cur=conn.cursor()
-    cur.execute("SELECT id,kind,status FROM games WHERE status='running' ORDER BY id DESC LIMIT 10;")
-    rows=cur.fetchall(); conn.close()
+    rows=await arunning_games(10)
     if not rows:
-        await update.message.reply_text("هیچ بازی running نیست.")
+        await reply(update.message, "هیچ بازی running نیست.")
         return
     kb=[]
     for r in rows:
         kb.append([InlineKeyboardButton(f"#{r['id']} ({r['kind']})", callback_data=f"adm:fg:{r['id']}")])
-    await update.message.reply_text("یک بازی رو انتخاب کن:", reply_markup=InlineKeyboardMarkup(kb))
+    await reply(update.message, "یک بازی رو انتخاب کن:", reply_markup=InlineKeyboardMarkup(kb))
 
 async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q=update.callback_query
@@ -1139,39 +3089,29 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     m=re.match(r"^adm\:(ap|rj)\:(\d+)$", data)
     if m:
         act=m.group(1); sid=int(m.group(2))
-        conn=db(); cur=conn.cursor()
-        cur.execute("SELECT * FROM suggestions WHERE id=?;",(sid,))
-        s=cur.fetchone()
-        if not s:
-            conn.close()
+        if not await areview_suggestion(sid, approve=(act=="ap")):
             return
-        if act=="ap":
-            cur.execute("UPDATE suggestions SET status='approved', reviewed_by=?, reviewed_at=? WHERE id=?;",(ADMIN_ID,now(),sid))
-            cur.execute("INSERT INTO questions (qtype,level,text,enabled,created_at) VALUES (?,?,?,?,?);",(s["qtype"],s["level"],s["text"],1,now()))
-        else:
-            cur.execute("UPDATE suggestions SET status='rejected', reviewed_by=?, reviewed_at=? WHERE id=?;",(ADMIN_ID,now(),sid))
-        conn.commit(); conn.close()
-        await q.message.reply_text("✅ انجام شد.")
+        await reply(q.message, "✅ انجام شد.")
         return
 
     m=re.match(r"^adm\:fg\:(\d+)$", data)
     if m:
         gid=int(m.group(1))
-        ps=list_players(gid)
+        ps=await alist_players(gid)
         if not ps:
-            await q.message.reply_text("بازیکنی ندارد.")
+            await reply(q.message, "بازیکنی ندارد.")
             return
         kb=[]
         for p in ps:
             kb.append([InlineKeyboardButton(p["name"], callback_data=f"adm:fp:{gid}:{p['user_id']}")])
-        await q.message.reply_text("بازیکن رو انتخاب کن:", reply_markup=InlineKeyboardMarkup(kb))
+        await reply(q.message, "بازیکن رو انتخاب کن:", reply_markup=InlineKeyboardMarkup(kb))
         return
 
     m=re.match(r"^adm\:fp\:(\d+)\:(\d+)$", data)
     if m:
         gid=int(m.group(1)); uid=int(m.group(2))
         flow_set(context,"force_text",{"gid":gid,"uid":uid})
-        await q.message.reply_text("متن سؤال سفارشی رو بفرست (همینجا):")
+        await reply(q.message, "متن سؤال سفارشی رو بفرست (همینجا):")
         return
 
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1185,16 +3125,11 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         qtype=flow["data"]["qtype"]; level=flow["data"]["level"]
         items=parse_bulk(update.message.text or "")
         if not items:
-            await update.message.reply_text("هیچی دریافت نشد.")
+            await reply(update.message, "هیچی دریافت نشد.")
             return
-        conn=db(); cur=conn.cursor()
-        cur.executemany(
-            "INSERT INTO questions (qtype,level,text,enabled,created_at) VALUES (?,?,?,?,?);",
-            [(qtype,level,t,1,now()) for t in items]
-        )
-        conn.commit(); conn.close()
+        await aadd_questions(qtype, level, items)
         flow_set(context,None)
-        await update.message.reply_text(f"✅ {len(items)} سؤال اضافه شد.")
+        await reply(update.message, f"✅ {len(items)} سؤال اضافه شد.")
         return
 
     if flow["name"]=="force_text":
@@ -1203,28 +3138,440 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         gid=int(flow["data"]["gid"]); uid=int(flow["data"]["uid"])
         txt=(update.message.text or "").strip()
         if not txt:
-            await update.message.reply_text("متن خالیه.")
+            await reply(update.message, "متن خالیه.")
             return
-        queue_forced(gid, uid, txt, qtype=None, level=None)
+        await aqueue_forced(gid, uid, txt, qtype=None, level=None)
+        await WRITER.durable()
         flow_set(context,None)
-        await update.message.reply_text("✅ سؤال مخفی صف شد (لو نمی‌رود).")
+        await reply(update.message, "✅ سؤال مخفی صف شد (لو نمی‌رود).")
         return
 
 # =========================
 # App
 # =========================
-def build_app() -> Application:
+def metrics_text() -> str:
+    out=[]
+    for m in (CALLBACK_SECONDS, DB_SECONDS, QUEUE_SECONDS, UPDATE_WAIT_SECONDS, BOARD_EDIT_SECONDS, TG_EDIT_SECONDS, COMMIT_BATCH, API_ERRORS):
+        m.expose(out)
+    statuses=collections.Counter(g["status"] for g in list(CACHE.games.values()))
+    gauges=[
+        ("dot_games", "Open games in the game cache by status.", [(f'status="{s}"', statuses.get(s,0)) for s in ("lobby","running")]),
+        ("dot_turn_timers_pending", "Turn deadlines waiting to fire.", [("", len(TIMERS.due))]),
+        ("dot_game_runtimes", "Live per-game runtime entries (board locks, pending edits).", [("", len(RUNTIME.games))]),
+        ("dot_cache_pending_writes", "Game-cache writes not yet flushed to SQLite.", [("", len(CACHE.pending))]),
+        ("dot_api_waiting", "Bot API calls waiting for a send slot.", [("", len(LIMITER.waiters))]),
+        ("dot_update_lanes", "Games/chats with updates queued or running.", [("", len(UPDATES.lanes))]),
+    ]
+    for name, help, values in gauges:
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} gauge")
+        for labels, v in values:
+            out.append(f"{name}{{{labels}}} {v}" if labels else f"{name} {v}")
+    out.append("# HELP dot_updates_total Updates at admission by outcome (lane_full: lane was full; dropped: clicks skipped for it).")
+    out.append("# TYPE dot_updates_total counter")
+    for k in ("admitted", "unordered", "lane_full", "dropped", "pending_full"):
+        out.append(f'dot_updates_total{{outcome="{k}"}} {UPDATES.stats[k]}')
+    out.append("# HELP dot_board_edits_total Board edit requests by outcome.")
+    out.append("# TYPE dot_board_edits_total counter")
+    for k, v in EDIT_STATS.items():
+        out.append(f'dot_board_edits_total{{outcome="{k}"}} {v}')
+    if WEBHOOK_URL:
+        out.append("# HELP dot_webhook_requests_total Webhook POSTs by result.")
+        out.append("# TYPE dot_webhook_requests_total counter")
+        for k, v in WEBHOOK_STATS.items():
+            out.append(f'dot_webhook_requests_total{{result="{k}"}} {v}')
+    return "\n".join(out)+"\n"
+
+async def _metrics_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request=await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        path=request.split(b" ",2)[1] if request.count(b" ")>=2 else b""
+        if path.split(b"?",1)[0]==b"/metrics":
+            status, ctype, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", metrics_text().encode()
+        else:
+            status, ctype, body = "404 Not Found", "text/plain", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()+body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def update_key(update: Update) -> Optional[str]:
+    """Ordering key: the game's board (group chat or inline message), else the chat or user. None = unordered."""
+    cq=update.callback_query
+    if cq:
+        if cq.inline_message_id:
+            return f"i{cq.inline_message_id}"
+        if cq.message:
+            return f"c{cq.message.chat.id}"
+        parsed=parse_callback(cq.data or "")
+        return f"g{parsed[0]}" if parsed else f"u{cq.from_user.id}"
+    if update.inline_query or update.chosen_inline_result:
+        return None
+    if update.effective_chat:
+        return f"c{update.effective_chat.id}"
+    return f"u{update.effective_user.id}" if update.effective_user else None
+
+class GameOrderedProcessor(BaseUpdateProcessor):
+    """Runs updates of different games concurrently and the updates of one game strictly in arrival order.
+
+    It declares max_concurrent_updates=1, so PTB's fetcher awaits do_process_update for each update in
+    turn. That call only *admits* the update into its key's lane (see update_key) and returns. A lane holds at
+    most UPDATE_LANE_MAX updates. A button click for a full lane is dropped (logged, counted, answered "wait":
+    the user taps again) instead of suspending intake for every other game; a message or command waits for
+    room, since it can't be repeated that way. The global bound, UPDATE_PENDING_MAX admitted updates, also
+    waits. Waiting fills the bounded update_queue and slows the webhook receiver / getUpdates loop.
+    Each lane is drained by one task (app.create_task, so Application.stop waits for it); at most
+    UPDATE_WORKERS handlers run at once across lanes.
+    """
+    def __init__(self, workers: int=UPDATE_WORKERS, lane_max: int=UPDATE_LANE_MAX, pending_max: int=UPDATE_PENDING_MAX):
+        super().__init__(max_concurrent_updates=1)
+        self.app: Optional[Application]=None  # set by build_app
+        self.lane_max=lane_max
+        self.workers=asyncio.Semaphore(workers)
+        self.room=asyncio.Semaphore(pending_max)
+        self.lanes={}
+        self.stats={"admitted": 0, "unordered": 0, "lane_full": 0, "dropped": 0, "pending_full": 0, "max_depth": 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        if self.room.locked():
+            self.stats["pending_full"]+=1
+        await self.room.acquire()
+        key=update_key(update) if isinstance(update, Update) else None
+        if key is None:
+            self.stats["unordered"]+=1
+            self.app.create_task(self._run(coroutine, "unordered", time.perf_counter()))
+            return
+        lane=self.lanes.get(key)
+        if lane is None:
+            lane=self.lanes[key]=asyncio.Queue(self.lane_max)
+            self.app.create_task(self._drain(key, lane))
+        if lane.full():
+            self.stats["lane_full"]+=1
+            if update.callback_query:
+                self.stats["dropped"]+=1
+                log.warning("Update lane %s full: dropped callback %r", key, update.callback_query.data)
+                coroutine.close()
+                self.room.release()
+                self.app.create_task(self._answer_busy(update.callback_query))
+                return
+            await lane.put((coroutine, time.perf_counter()))
+            if self.lanes.get(key) is not lane:
+                # its drain task saw the lane empty and quit before this put resumed
+                self.lanes[key]=lane
+                self.app.create_task(self._drain(key, lane))
+        else:
+            lane.put_nowait((coroutine, time.perf_counter()))
+        self.stats["admitted"]+=1
+        self.stats["max_depth"]=max(self.stats["max_depth"], lane.qsize())
+
+    async def _answer_busy(self, q):
+        try:
+            await q.answer("⏳ کمی صبر کن و دوباره بزن.")
+        except Exception as e:
+            log.debug("Busy answer failed: %s", e)
+
+    async def _drain(self, key: str, lane: asyncio.Queue):
+        # the last empty check and the delete happen without awaiting in between, so nothing is admitted to a dropped lane
+        try:
+            while not lane.empty():
+                coroutine, t = lane.get_nowait()
+                await self._run(coroutine, "ordered", t)
+        finally:
+            if self.lanes.get(key) is lane:
+                del self.lanes[key]
+
+    async def _run(self, coroutine, kind: str, admitted: float):
+        try:
+            async with self.workers:
+                UPDATE_WAIT_SECONDS.observe(kind, time.perf_counter()-admitted)
+                await coroutine
+        except Exception:
+            log.exception("Update handling failed")
+        finally:
+            self.room.release()
+
+UPDATES = GameOrderedProcessor()
+
+WEBHOOK_STATS = {"accepted": 0, "forbidden": 0, "bad": 0}
+
+class WebhookReceiver:
+    """Telegram webhook endpoint on a bare asyncio server.
+
+    Speaks just enough HTTP/1.1 for Telegram: keep-alive, Content-Length bodies, POST to one path.
+    The secret header is checked (constant time) before the body is read; accepted updates go
+    straight onto app.update_queue and are answered 200 at once, so Telegram never waits on a handler.
+    """
+    def __init__(self, app: Application, path: str, secret: str, max_body: int=WEBHOOK_MAX_BODY):
+        self.app=app
+        self.path=path.encode()
+        self.secret=secret.encode()
+        self.max_body=max_body
+        self.server=None
+
+    async def start(self, host: str, port: int, ssl_context: Optional[ssl.SSLContext]=None):
+        self.server=await asyncio.start_server(self._client, host, port, ssl=ssl_context)
+        return self.server
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            keep=True
+            while keep:
+                head=await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=60)
+                status, keep = await self._request(head, reader)
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n"
+                             f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n".encode())
+                await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _request(self, head: bytes, reader: asyncio.StreamReader) -> Tuple[str, bool]:
+        """-> (status line, keep the connection). Anything rejected before its body is read closes the connection."""
+        lines=head.split(b"\r\n")
+        parts=lines[0].split(b" ")
+        if len(parts)!=3:
+            WEBHOOK_STATS["bad"]+=1
+            return "400 Bad Request", False
+        method, target, version = parts
+        headers={}
+        for line in lines[1:]:
+            k, sep, v = line.partition(b":")
+            if sep:
+                headers[k.strip().lower()]=v.strip()
+        if target.split(b"?",1)[0]!=self.path:
+            return "404 Not Found", False
+        if method!=b"POST":
+            return "405 Method Not Allowed", False
+        if not hmac.compare_digest(headers.get(b"x-telegram-bot-api-secret-token", b""), self.secret):
+            WEBHOOK_STATS["forbidden"]+=1
+            return "403 Forbidden", False
+        if b"transfer-encoding" in headers:
+            WEBHOOK_STATS["bad"]+=1
+            return "411 Length Required", False
+        try:
+            n=int(headers.get(b"content-length", b""))
+        except ValueError:
+            WEBHOOK_STATS["bad"]+=1
+            return "411 Length Required", False
+        if not 0<n<=self.max_body:
+            WEBHOOK_STATS["bad"]+=1
+            return "413 Payload Too Large", False
+        body=await reader.readexactly(n)
+        keep=version==b"HTTP/1.1" and headers.get(b"connection", b"").lower()!=b"close"
+        try:
+            update=Update.de_json(json.loads(body), self.app.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            WEBHOOK_STATS["bad"]+=1
+            return "400 Bad Request", keep
+        await self.app.update_queue.put(update)
+        WEBHOOK_STATS["accepted"]+=1
+        return "200 OK", keep
+
+async def serve_webhook(app: Application):
+    """Webhook counterpart of run_polling: same lifecycle and hooks, WebhookReceiver instead of the Updater."""
+    stop=asyncio.Event()
+    loop=asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    ssl_context=None
+    if WEBHOOK_CERT:
+        ssl_context=ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY or None)
+    receiver=WebhookReceiver(app, WEBHOOK_PATH, WEBHOOK_SECRET)
+    await app.initialize()
+    try:
+        await app.post_init(app)
+        await receiver.start(WEBHOOK_HOST, WEBHOOK_PORT, ssl_context)
+        await app.start()
+        with open(WEBHOOK_CERT, "rb") if WEBHOOK_CERT else nullcontext() as cert:
+            await app.bot.set_webhook(WEBHOOK_URL, certificate=cert, secret_token=WEBHOOK_SECRET,
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+        log.info("Bot is running (webhook %s -> %s:%d%s)", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await stop.wait()
+    finally:
+        receiver.close()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+class GroupCommitWriter:
+    """The one task that commits the game cache's queued writes, in batches (group commit).
+
+    Handlers only queue writes (CACHE.write). A batch goes out GAME_FLUSH_SEC
+    after the previous one, or GAME_COMMIT_LINGER_MS after a kick: GAME_FLUSH_OPS
+    writes pending, or a handler awaiting durable(). One commit releases every
+    durable() caller whose writes it covered.
+    """
+    def __init__(self):
+        self.loop=None
+        self.kicked=None   # asyncio.Event, set by kicks
+        self.waiters=[]    # [(CACHE.queued at the call, future)]
+        self.stats={"full": 0, "durable": 0, "failed": 0}
+
+    def start(self) -> asyncio.Task:
+        self.loop=asyncio.get_running_loop()
+        self.kicked=asyncio.Event()
+        CACHE.on_full=self._kick_full
+        return asyncio.create_task(self.run())
+
+    def _kick_full(self):
+        # called by CACHE.write, usually on the DB thread
+        self.stats["full"]+=1
+        self.loop.call_soon_threadsafe(self.kicked.set)
+
+    async def durable(self):
+        """Return once every game write queued before the call is committed to SQLite;
+        raises the commit's error if that batch failed (its writes stay queued for a retry)."""
+        seq=CACHE.queued
+        if CACHE.durable>=seq:
+            return
+        if self.kicked is None:  # writer not running (scripts, benches): commit inline
+            await run_db(CACHE.flush, "durable")
+            return
+        self.stats["durable"]+=1
+        fut=self.loop.create_future()
+        self.waiters.append((seq, fut))
+        self.kicked.set()
+        await fut
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.kicked.wait(), GAME_FLUSH_SEC)
+                trigger="durable" if self.waiters else "full"
+                await asyncio.sleep(GAME_COMMIT_LINGER_MS/1000)
+            except asyncio.TimeoutError:
+                trigger="timer"
+            self.kicked.clear()
+            await self.commit(trigger)
+
+    async def commit(self, trigger: str):
+        waiters, self.waiters = self.waiters, []
+        try:
+            await run_db(CACHE.flush, trigger)
+        except Exception as e:
+            self.stats["failed"]+=1
+            log.error("Game cache flush failed: %s", e)
+            for _, fut in waiters:
+                if not fut.done(): fut.set_exception(e)
+            return
+        for seq, fut in waiters:
+            if CACHE.durable<seq:
+                self.waiters.append((seq, fut)); self.kicked.set()
+            elif not fut.done():
+                fut.set_result(None)
+
+    async def close(self):
+        """Final commit at shutdown; releases anyone still waiting."""
+        CACHE.on_full=None
+        await self.commit("shutdown")
+        self.kicked=None
+
+    def summary(self, window: float=60.0) -> dict:
+        """Commit rate and batch sizes over the last `window` seconds."""
+        cut=time.monotonic()-window
+        sizes=sorted(n for t, n in list(CACHE.commits) if t>=cut)
+        pick=lambda p: sizes[min(len(sizes)-1, int(len(sizes)*p))] if sizes else 0
+        return {"rate": round(len(sizes)/window, 2), "p50": pick(.5), "p95": pick(.95), "max": sizes[-1] if sizes else 0}
+
+WRITER = GroupCommitWriter()
+
+async def runtime_sweep_loop():
+    while True:
+        await asyncio.sleep(RUNTIME_SWEEP_SEC)
+        # the cache lock is held on the DB thread for whole flushes: take a consistent snapshot
+        # there (a SHARED_DB reload evicts and re-adds a game within one hold) and sweep here
+        since=time.monotonic(); timed=list(TIMERS.due)
+        live=await run_db(CACHE.live_gids)
+        RUNTIME.sweep(live, since)
+        for gid in timed:
+            if gid not in live:
+                TIMERS.cancel(gid)
+
+async def retention_loop():
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL_SEC)
+        try:
+            # one batch per DB-thread hop so handlers interleave with a large backlog
+            while await run_db(end_idle_games, RETENTION_BATCH)==RETENTION_BATCH:
+                pass
+            while await run_db(archive_ended_games, RETENTION_BATCH)==RETENTION_BATCH:
+                pass
+            await run_db(compact_db)
+        except Exception as e:
+            log.error("Retention run failed: %s", e)
+
+async def on_startup(app: Application):
+    app.bot_data["bg_tasks"]=[
+        WRITER.start(), asyncio.create_task(runtime_sweep_loop()),
+        asyncio.create_task(retention_loop()), TIMERS.start(app),
+    ]
+    # overdue deadlines fire on the scheduler's first pass
+    for gid, actor, deadline in await run_db(recover_deadlines):
+        TIMERS.push(gid, actor, deadline)
+        TIMERS.stats["recovered"]+=1
+    log.info("Turn timers: %d deadlines recovered", TIMERS.stats["recovered"])
+    if METRICS_PORT:
+        app.bot_data["metrics_server"]=await asyncio.start_server(_metrics_client, METRICS_HOST, METRICS_PORT)
+        log.info("Metrics on http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+
+async def on_shutdown(app: Application):
+    for t in app.bot_data.get("bg_tasks", []):
+        t.cancel()
+    server=app.bot_data.get("metrics_server")
+    if server:
+        server.close()
+    await WRITER.close()
+    s=POOL.stats()
+    log.info("DB pool: opened=%d reused=%d", s["opened"], s["reused"])
+    DB_EXECUTOR.shutdown(wait=True)
+    for ex in SHARD_EXECUTORS:
+        ex.shutdown(wait=True)
+    for pool in [POOL]+SHARDS:
+        pool.close()
+
+def build_app(request: Optional[BaseRequest]=None, get_updates_request: Optional[BaseRequest]=None) -> Application:
+    """`request` / `get_updates_request` replace the HTTP transports to api.telegram.org
+    (benchmarks drive a local stand-in)."""
     init_db()
     seed_if_empty()
+    # abandoned games would otherwise be reloaded into the cache on every start
+    while end_idle_games()==RETENTION_BATCH:
+        pass
+    CACHE.rebuild()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    builder = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    builder = builder.concurrent_updates(UPDATES).update_queue(asyncio.Queue(UPDATE_QUEUE_MAX))
+    # same pool size PTB picks for its default bot transport
+    builder = builder.request(TracedRequest(request or HTTPXRequest(connection_pool_size=256)))
+    if get_updates_request:
+        builder = builder.get_updates_request(get_updates_request)
+    app = builder.build()
+    UPDATES.app = app
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("startgame", cmd_startgame))
+    app.add_handler(CommandHandler("top", cmd_top))
 
     app.add_handler(CommandHandler("admin", cmd_admin))
     app.add_handler(CommandHandler("pending", cmd_pending))
     app.add_handler(CommandHandler("force", cmd_force))
+    app.add_handler(CommandHandler("perf", cmd_perf))
+    app.add_handler(CommandHandler("disable", cmd_disable))
 
     app.add_handler(CommandHandler("bulk_truth", lambda u,c: cmd_bulk(u,c,"truth","normal")))
     app.add_handler(CommandHandler("bulk_dare", lambda u,c: cmd_bulk(u,c,"dare","normal")))
@@ -1234,6 +3581,7 @@ def build_app() -> Application:
     app.add_handler(InlineQueryHandler(inline_query))
 
     app.add_handler(CallbackQueryHandler(admin_cb, pattern=r"^adm:"))
+    app.add_handler(CallbackQueryHandler(top_cb, pattern=r"^top:"))
     app.add_handler(CallbackQueryHandler(callback_router))
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
@@ -1242,5 +3590,8 @@ def build_app() -> Application:
 
 if __name__ == "__main__":
     application = build_app()
-    log.info("Bot is running (polling)...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
\ No newline at end of file
+    if WEBHOOK_URL:
+        asyncio.run(serve_webhook(application))
+    else:
+        log.info("Bot is running (polling)...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
\ No newline at end of file